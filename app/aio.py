@@ -0,0 +1,114 @@
+import asyncio
+import functools
+import os
+import threading
+
+import httpx
+
+# Defaults, overridable through the environment
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", 100)) # Open connections to upstream per worker
+UPSTREAM_KEEPALIVE_CONNECTIONS = 20 # Idle connections kept open for the next search
+
+
+class PooledClient:
+    """
+    Shared httpx.AsyncClient that queues requests beyond its connection limit
+    itself. httpcore's pool rescans its whole queue on every request, which
+    turns into a busy loop with hundreds of pages waiting, and counts queueing
+    against the request timeout.
+    """
+
+    def __init__(self, timeout, max_connections):
+        self.client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=UPSTREAM_KEEPALIVE_CONNECTIONS)
+        )
+        self._slots = asyncio.Semaphore(max_connections)
+
+    async def post(self, *args, **kwargs):
+        async with self._slots:
+            return await self.client.post(*args, **kwargs)
+
+
+class BackgroundLoop:
+    """
+    One asyncio event loop per worker process, running in a daemon thread. Request
+    threads hand their upstream I/O to it and block until it is done, so every
+    search waiting on the network shares one loop and one connection pool. A
+    waiting search then costs a parked thread, not a loop and fresh connections of its own.
+    """
+
+    def __init__(self, max_connections=UPSTREAM_MAX_CONNECTIONS):
+        self.max_connections = max_connections
+        self._loop = None
+        self._pid = None
+        self._client = None
+        self._lock = threading.Lock()
+
+    def loop(self):
+        """
+        Returns the running loop, starting it on first use, and again in a forked worker
+        since the parent's loop thread does not exist there.
+        """
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="asyncio-loop", daemon=True).start()
+                self._loop = loop
+                self._pid = os.getpid()
+                self._client = None
+            return self._loop
+
+    def is_current(self):
+        """
+        Returns whether the calling coroutine runs on this loop.
+        """
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def run(self, coroutine):
+        """
+        Runs coroutine on the loop and waits for its result. The caller's context
+        variables (e.g. the request's metrics) carry over to it.
+
+        Args:
+            coroutine (coroutine): The coroutine to run.
+
+        Returns:
+            The coroutine's result.
+        """
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop())
+        try:
+            return future.result()
+        finally:
+            # No-op once finished, stops the coroutine if the caller was interrupted
+            future.cancel()
+
+    def client(self, timeout):
+        """
+        Returns the worker's shared PooledClient. Only for coroutines running on this loop.
+
+        Args:
+            timeout (float): Seconds per request, applied when the client is created.
+        """
+        if self._client is None:
+            self._client = PooledClient(timeout, self.max_connections)
+        return self._client
+
+
+async def run_blocking(function, *args, **kwargs):
+    """
+    Runs a call that can block on another process, e.g. a SQLite write waiting for a
+    lock another worker holds, in the loop's thread pool. The loop keeps serving
+    every other search of the worker meanwhile.
+
+    Returns:
+        The call's result.
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(function, *args, **kwargs))
+
+
+background = BackgroundLoop()
@@ -1,8 +1,21 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_from_directory
+from flask import Flask, Response, flash, g, render_template, request, jsonify, session, redirect, url_for, send_from_directory, stream_with_context
 from flask_session import Session
+from app.assets import CatalogAssets, IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL
+from app.batch import BatchError, run_batch
+from app.export import EXPORT_FORMATS, export_chunks, export_slots, gzip_stream
 from app.scrape import ActivityScraper
-from app.database_utils import get_activity_parks, DB_PATH
-import sqlite3
+from app.database_utils import get_activity_parks, get_catalog
+from app.db import DB_PATH, read_connection
+from app.geo import nearby_parks
+from app.grouping import ActivityGrouper
+from app.metrics import registry as metrics, span, start_request
+from app.prefetch import Prefetcher
+from app.records import to_json
+from app.result_store import ResultStore
+from app.upstream import UpstreamUnavailable
+from app.snapshot import search_snapshot, snapshot_taken_at, snapshot_is_fresh, SNAPSHOT_MIN_OPEN_SLOTS
+import os
+import time
 
 app = Flask(__name__,
             template_folder="../templates",
@@ -10,15 +23,109 @@ app = Flask(__name__,
 app.config["SESSION_TYPE"] = "filesystem"
 Session(app)
 
+# "live" proxies every search upstream, "snapshot" answers from the local catalog while it is fresh
+app.config["SEARCH_SOURCE"] = os.environ.get("SEARCH_SOURCE", "live")
+
+# Fetch the next load_more batch in the background as soon as a search has more results
+app.config["PREFETCH_NEXT_BATCH"] = os.environ.get("PREFETCH_NEXT_BATCH") == "1"
+
+# Stream live searches to the results page page-by-page instead of blocking /search
+app.config["STREAM_RESULTS"] = os.environ.get("STREAM_RESULTS", "1") == "1"
+
 # Paths
-DB_PATH = "data/chicago_activities.db"
-SPATIALITE_PATH = "/opt/homebrew/lib/mod_spatialite.dylib"
 RESULTS_PATH = "results.html"
 INDEX_PATH = "index.html"
 
-# Utility function: scrape activities based on form dat
-def use_scraper(form_data, first_page=1):
-    """Initializes and uses the ActivityScraper to fetch activities."""
+# Grouped activities live here, the session only keeps the search id
+result_store = ResultStore()
+MAX_RESULTS_PAGE_SIZE = 200
+
+# Background fetches of the next batch, keyed by search id, claimable by any worker through the result store
+prefetcher = Prefetcher(store=result_store)
+
+# Session writes happen after the response is built, time them for /metrics
+_save_session = app.session_interface.save_session
+def save_session(*args, **kwargs):
+    with span("session"):
+        return _save_session(*args, **kwargs)
+app.session_interface.save_session = save_session
+
+# Copy cache and prefetch counters into /metrics
+def collect_stats(registry):
+    page_cache = ActivityScraper.page_cache.stats()
+    registry.set("page_cache_hits_total", page_cache["hits"])
+    registry.set("page_cache_misses_total", page_cache["misses"])
+    prefetch = prefetcher.stats()
+    for key in ("scheduled", "hits", "misses", "wasted"):
+        registry.set(f"prefetch_{key}_total", prefetch[key])
+    registry.set("prefetch_pending", prefetch["pending"])
+
+metrics.add_collector(collect_stats)
+
+# Load reference data once per worker, it reloads itself if the database changes
+if os.path.exists(DB_PATH):
+    get_catalog(DB_PATH)
+
+# Per-request phase timings
+@app.before_request
+def start_timing():
+    g.request_metrics = start_request()
+
+@app.after_request
+def record_timing(response):
+    request_metrics = g.get("request_metrics")
+    if request_metrics is not None:
+        response.headers["Server-Timing"] = request_metrics.server_timing()
+        metrics.observe("http_request_duration_seconds", time.perf_counter() - request_metrics.start,
+                        endpoint=request.endpoint or "none", status=response.status_code)
+        metrics.flush()
+    return response
+
+# Upstream down and nothing cached to fall back on
+UPSTREAM_UNAVAILABLE_MESSAGE = "The Park District's site is not responding right now. Please try again in a minute."
+
+@app.errorhandler(UpstreamUnavailable)
+def upstream_unavailable(error):
+    return jsonify({"success": False, "error": UPSTREAM_UNAVAILABLE_MESSAGE}), 503
+
+# Utility function: JSON response for payloads holding activity records
+def json_response(payload, status=200):
+    """Serializes payload with the compact record encoder, skipping jsonify's key sorting."""
+    return Response(to_json(payload), status=status, mimetype="application/json")
+
+# Utility function: render the home page for a catalog version
+def render_index(catalog, assets):
+    """Renders the search page once for catalog, linking the versioned parks GeoJSON."""
+    with span("render"):
+        return render_template(INDEX_PATH,
+                               parks_url=url_for("parks_geojson", v=assets["version"]),
+                               all_categories=catalog.categories,
+                               all_age_groups=catalog.age_groups,
+                               open_slots=1)
+
+# Reference data responses, rebuilt when the database changes
+catalog_assets = CatalogAssets(render_index)
+
+# Utility function: serve a precomputed reference data response
+def versioned_asset(name):
+    """Serves one of the catalog assets. Requests for the current version (?v=) may be
+    cached for good, since a new database gets a new version and so a new URL."""
+    assets = catalog_assets.get(get_catalog(DB_PATH))
+    cache_control = IMMUTABLE_CACHE_CONTROL if request.args.get("v") == assets["version"] else REVALIDATE_CACHE_CONTROL
+    return assets[name].respond(request, cache_control)
+
+# Utility function: read an age from the search form
+def parse_age(value):
+    """Returns a whole number of years from a form field, or None if blank or invalid."""
+    try:
+        age = int(value)
+    except (TypeError, ValueError):
+        return None
+    return age if 0 <= age <= 120 else None
+
+# Utility function: build a scraper from form data
+def build_scraper(form_data, first_page=1):
+    """Initializes an ActivityScraper from the search form."""
     # Build location tuple using fetched address
     user_lat_list = form_data.get("user_lat", [None])
     user_lon_list = form_data.get("user_lon", [None])
@@ -35,57 +142,95 @@ def use_scraper(form_data, first_page=1):
     open_slots_list = form_data.get('open_slots', [1])
     open_slots = int(open_slots_list[0]) if open_slots_list[0] else 1
 
+    # Build age range and days using form
+    min_age = parse_age(form_data.get("min_age", [None])[0])
+    max_age = parse_age(form_data.get("max_age", [None])[0])
+    if min_age is not None and max_age is not None and min_age > max_age:
+        min_age, max_age = max_age, min_age
+
     # Create scraper instance
-    scraper = ActivityScraper(
+    return ActivityScraper(
         distance_miles=distance_miles,
         parks=form_data.get("parks", []),
         categories=form_data.get("categories", []),
         age_groups=form_data.get("age_groups", []),
         open_slots=open_slots,
         location=location,
+        min_age=min_age,
+        max_age=max_age,
+        days_of_week=form_data.get("days_of_week", []),
         first_page=first_page
     )
+
+# Utility function: answer a search from the local snapshot
+def use_snapshot(form_data, first_page=1, grouper=None):
+    """Searches the local snapshot if enabled, fresh and not overridden by the form's "live" flag.
+    Returns None when the search has to go upstream."""
+    if first_page != 1 or app.config["SEARCH_SOURCE"] != "snapshot" or form_data.get("live"):
+        return None
+
+    taken_at = snapshot_taken_at()
+    if not snapshot_is_fresh(taken_at):
+        return None
+
+    scraper = build_scraper(form_data, first_page)
+    if scraper.open_slots < SNAPSHOT_MIN_OPEN_SLOTS:
+        return None
+
+    results_as_of = taken_at.isoformat(sep=" ", timespec="minutes")
+    if scraper.no_matching_parks:
+        return [], False, None, results_as_of
+
+    activities = search_snapshot(
+        # Radius searches were resolved to the nearby parks by the scraper
+        parks=form_data.get("parks", []) or list(scraper.park_distances),
+        categories=form_data.get("categories", []),
+        age_groups=form_data.get("age_groups", []),
+        open_slots=scraper.open_slots
+    )
+    scraper.activities = [activity for activity in activities if scraper.matches_filters(activity)]
+    scraper.dedeup_activities(grouper)
+
+    # Snapshot returns every match at once, nothing left to load
+    return scraper.activities, False, None, results_as_of
+
+# Utility function: start fetching the batch after the one just shown
+def prefetch_next_batch(search_id, form_data, next_page):
+    """Schedules a background fetch of the batch starting at next_page, the first page not yet shown."""
+    if app.config["PREFETCH_NEXT_BATCH"] and search_id:
+        prefetcher.schedule(search_id, build_scraper(form_data, first_page=next_page))
+
+# Utility function: scrape activities based on form dat
+def use_scraper(form_data, first_page=1, grouper=None):
+    """Initializes and uses the ActivityScraper to fetch activities.
+    Returns only the groups this batch created or changed in grouper, whether there are more,
+    the page to load them from and when the results were taken (None for live results)."""
+    snapshot_results = use_snapshot(form_data, first_page, grouper)
+    if snapshot_results is not None:
+        return snapshot_results
+
+    scraper = build_scraper(form_data, first_page)
     scraper.get_activities()
-    scraper.dedeup_activities()
-    return scraper.activities, scraper.more_results_to_fetch
+    scraper.dedeup_activities(grouper)
+    return scraper.activities, scraper.more_results_to_fetch, scraper.next_page, None
 
 # Route: Home page search form
 @app.route("/", methods=["GET"])
 def index():
-    """Renders the main search page with parks, categories, and age groups."""
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-
-        # Fetch park data
-        cur.execute("SELECT name, latitude, longitude FROM parks")
-        parks = [
-            {"name": name, "latitude": latitude, "longitude": longitude}
-            for name, latitude, longitude in cur.fetchall()
-        ]
+    """Serves the main search page, rendered once per database version."""
+    return catalog_assets.get(get_catalog(DB_PATH))["index"].respond(request)
+
+# Route: Parks as GeoJSON, for the home page map and park picker
+@app.route("/parks.geojson")
+def parks_geojson():
+    """Serves all parks as a GeoJSON FeatureCollection."""
+    return versioned_asset("parks")
 
-        # Fetch categories
-        cur.execute("""
-            SELECT DISTINCT name 
-            FROM activities 
-            WHERE type = 'ActivityOtherCategoryID' 
-            ORDER BY name
-        """)
-        all_categories = [row[0] for row in cur.fetchall()]
-
-        # Fetch age groups
-        cur.execute("""
-            SELECT DISTINCT name 
-            FROM activities 
-            WHERE type = 'ActivityCategoryID' 
-            ORDER BY name
-        """)
-        all_age_groups = [row[0] for row in cur.fetchall()]
-
-    return render_template(INDEX_PATH,
-                           parks=parks,
-                           all_categories=all_categories,
-                           all_age_groups=all_age_groups,
-                           open_slots=1)
+# Route: Activity categories and age groups
+@app.route("/categories.json")
+def categories_json():
+    """Serves the activity categories and age groups."""
+    return versioned_asset("categories")
 
 # Route: Search activities
 @app.route("/search", methods=["POST"])
@@ -93,25 +238,99 @@ def search():
     """Handles form submission and starts an activity search."""
     form_data = request.form.to_dict(flat=False)
 
+    # A new search makes any prefetch for the previous one useless
+    prefetcher.cancel(session.get("search_id"))
+
     session["first_page"] = 1 
+    session["search_form"] = form_data
 
-    activities, more_results_to_fetch = use_scraper(form_data)
+    grouper = ActivityGrouper()
+    if app.config["STREAM_RESULTS"]:
+        snapshot_results = use_snapshot(form_data, grouper=grouper)
+        if snapshot_results is None:
+            # Results page fetches this search from /search/stream as it arrives
+            session["search_id"] = result_store.new_search(complete=False)
+            session["results_as_of"] = None
+            return redirect(url_for("results"))
+        activities, more_results_to_fetch, next_page, results_as_of = snapshot_results
+    else:
+        try:
+            activities, more_results_to_fetch, next_page, results_as_of = use_scraper(form_data, grouper=grouper)
+        except UpstreamUnavailable:
+            # A form post, so show the message on the results page rather than the JSON error
+            flash(UPSTREAM_UNAVAILABLE_MESSAGE)
+            session["search_id"] = result_store.new_search()
+            session["results_as_of"] = None
+            return redirect(url_for("results"))
 
-    # Store form and activity results in session
-    session["search_form"] = form_data
-    session["activities"] = activities
-    session["more_results_to_fetch"] = more_results_to_fetch
+    # Store results server-side and keep the form and search id in session
+    session["search_id"] = result_store.new_search(grouper, more_results_to_fetch, next_page=next_page)
+    session["results_as_of"] = results_as_of
+
+    if more_results_to_fetch:
+        prefetch_next_batch(session["search_id"], form_data, next_page)
 
     return redirect(url_for("results"))
 
+# Route: Stream search results
+@app.route("/search/stream", methods=["POST"])
+def search_stream():
+    """Streams the pending search as NDJSON, one line of grouped activities per upstream page."""
+    search_id = session.get("search_id")
+    search_form = session.get("search_form", {})
+    if not search_id or not search_form:
+        return jsonify({"success": False, "error": "Missing search parameters"}), 400
+
+    complete, more_results_to_fetch = result_store.status(search_id)
+    if complete:
+        # Already fetched (e.g. page reload), send what is stored
+        activities = result_store.get(search_id)
+        lines = [
+            {"activities": activities, "activity_parks": get_activity_parks(activities)},
+            {"done": True, "more_results_to_fetch": more_results_to_fetch,
+             "next_page": result_store.next_page(search_id)}
+        ]
+        return Response((to_json(line) + "\n" for line in lines), mimetype="application/x-ndjson")
+
+    scraper = build_scraper(search_form)
+
+    def generate():
+        # Later pages merge into groups sent earlier, so send every group a page touched
+        grouper = ActivityGrouper()
+        try:
+            for page in scraper.iter_pages():
+                groups = scraper.merge_groups(grouper, page)
+                yield to_json({"activities": groups, "activity_parks": get_activity_parks(groups)}) + "\n"
+        except UpstreamUnavailable:
+            result_store.save(search_id, grouper)
+            yield to_json({"done": True, "more_results_to_fetch": False, "error": UPSTREAM_UNAVAILABLE_MESSAGE}) + "\n"
+            return
+
+        result_store.save(search_id, grouper, scraper.more_results_to_fetch, next_page=scraper.next_page)
+        if scraper.more_results_to_fetch:
+            prefetch_next_batch(search_id, search_form, scraper.next_page)
+        yield to_json({"done": True, "more_results_to_fetch": scraper.more_results_to_fetch,
+                       "next_page": scraper.next_page}) + "\n"
+
+    response = Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no" # Don't let a proxy hold back lines
+    return response
+
 # Route: Results page
 @app.route("/results")
 def results():
     """Displays the list of found activities and park map."""
-    activities = session.get("activities", [])
+    search_id = session.get("search_id")
+    activities = result_store.get(search_id)
     activity_parks = get_activity_parks(activities)
-    show_load_more = session.get("more_results_to_fetch", False)
-    return render_template(RESULTS_PATH, activities=activities, activity_parks=activity_parks, show_load_more=show_load_more)
+    complete, show_load_more = result_store.status(search_id)
+    next_page = result_store.next_page(search_id) if show_load_more else None
+    results_as_of = session.get("results_as_of")
+    with span("render"):
+        return render_template(RESULTS_PATH, activities=activities, activity_parks=activity_parks,
+                               show_load_more=show_load_more, next_page=next_page,
+                               results_as_of=results_as_of, stream_results=not complete)
 
 # Route: Load more activities
 @app.route("/load_more", methods=["POST"])
@@ -127,51 +346,143 @@ def load_more():
     if not search_form:
         return jsonify({"success": False, "error": "Missing search parameters"}), 400
 
-    # Fetch next batch of activities
-    activities, more_results_to_fetch = use_scraper(search_form, first_page=int(current_page))
+    first_page = int(current_page)
+    search_id = session.get("search_id")
 
-    if "activities" not in session:
-        session["activities"] = []
+    # Merge into the groups already shown, so only new or changed groups are returned
+    grouper = result_store.grouper(search_id)
 
-    session["activities"].extend(activities)
+    # Use the prefetched batch if there is one, otherwise fetch it now
+    scraper = None
+    if app.config["PREFETCH_NEXT_BATCH"]:
+        scraper = prefetcher.claim(search_id, first_page, lambda: build_scraper(search_form, first_page))
+    if scraper is not None:
+        scraper.dedeup_activities(grouper)
+        activities, more_results_to_fetch = scraper.activities, scraper.more_results_to_fetch
+        next_page = scraper.next_page
+    else:
+        activities, more_results_to_fetch, next_page, _ = use_scraper(search_form, first_page=first_page, grouper=grouper)
 
-    return jsonify({
+    if search_id:
+        result_store.save(search_id, grouper, more_results_to_fetch, next_page=next_page)
+        if more_results_to_fetch:
+            prefetch_next_batch(search_id, search_form, next_page)
+
+    return json_response({
         "success": True,
-        "activities": activities, 
+        "activities": activities,
         "activity_parks": get_activity_parks(activities),
-        "more_results_to_fetch": more_results_to_fetch
+        "more_results_to_fetch": more_results_to_fetch,
+        "next_page": next_page
     })
 
+# Route: Paginated results as JSON
+@app.route("/results.json")
+def results_json():
+    """Returns a slice of the current search's activities."""
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    limit = min(max(request.args.get("limit", 50, type=int), 1), MAX_RESULTS_PAGE_SIZE)
+
+    activities, total = result_store.page(session.get("search_id"), offset, limit)
+    return json_response({
+        "success": True,
+        "offset": offset,
+        "total": total,
+        "activities": activities
+    })
+
+# Route: Run many saved searches at once
+@app.route("/batch_search", methods=["POST"])
+def batch_search():
+    """Runs a list of filter sets, fetching what they share once, and returns each one's grouped activities."""
+    request_data = request.get_json(silent=True)
+    specs = request_data.get("searches") if isinstance(request_data, dict) else request_data
+    try:
+        result = run_batch(specs)
+    except BatchError as error:
+        return jsonify({"success": False, "error": str(error)}), 400
+    return json_response({"success": True, **result})
+
+# Route: Export every result of the current search
+@app.route("/export")
+def export():
+    """Streams every result of the current search as NDJSON or CSV, optionally gzipped, in constant memory."""
+    search_form = session.get("search_form", {})
+    if not search_form:
+        return jsonify({"success": False, "error": "Missing search parameters"}), 400
+    export_format = request.args.get("format", "ndjson")
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"success": False, "error": f"Format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+    use_gzip = request.args.get("gzip", "0") not in ("", "0", "false")
+
+    if not export_slots.acquire(blocking=False):
+        response = jsonify({"success": False, "error": "Too many exports running, please try again shortly"})
+        response.headers["Retry-After"] = "30"
+        return response, 429
+
+    released = []
+    def release():
+        # Called when the stream ends and when the response closes, whichever comes first
+        if not released:
+            released.append(True)
+            export_slots.release()
+
+    try:
+        scraper = build_scraper(search_form)
+    except Exception:
+        release()
+        raise
+
+    def generate():
+        try:
+            for text, _ in export_chunks(scraper, export_format):
+                yield text
+        except UpstreamUnavailable:
+            metrics.inc("export_incomplete_total")
+            if export_format == "csv" or use_gzip:
+                # Raising mid-stream aborts the connection before the final chunk (or gzip
+                # trailer), so the client sees a failed download rather than a short file
+                raise
+            yield to_json({"error": UPSTREAM_UNAVAILABLE_MESSAGE, "complete": False}) + "\n"
+        finally:
+            release()
+
+    body = gzip_stream(generate()) if use_gzip else generate()
+    mimetype = "text/csv" if export_format == "csv" else "application/x-ndjson"
+    response = Response(stream_with_context(body), mimetype=mimetype)
+    # Also released if the client goes away before the stream starts
+    response.call_on_close(release)
+    filename = f"activities.{'csv' if export_format == 'csv' else 'ndjson'}{'.gz' if use_gzip else ''}"
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
 # Route: Find nearby parks
 @app.route("/find_nearby_parks", methods=["POST"])
 def find_nearby_parks():
     """Finds parks near a given latitude/longitude."""
     data = request.get_json()
-    lat, lon = data["lat"], data["lon"]
-    radius = float(data.get("radius", 2)) * 1609.34  # Convert miles to meters
-
-    query = """
-        SELECT name, latitude, longitude
-        FROM parks
-        WHERE 6371000 * acos(
-            cos(radians(?)) * cos(radians(latitude)) *
-            cos(radians(longitude) - radians(?)) +
-            sin(radians(?)) * sin(radians(latitude))
-        ) <= ?
-    """
-
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-        cur.execute(query, (lat, lon, lat, radius))
-        results = cur.fetchall()
+    lat, lon = float(data["lat"]), float(data["lon"])
+    radius = float(data.get("radius", 2))
+    limit = int(data["limit"]) if data.get("limit") else None
+
+    # Bounding box prefilter on the spatial index, then exact distances, nearest first
+    results = nearby_parks(read_connection(DB_PATH), lat, lon, radius_miles=radius, limit=limit)
 
     return jsonify({
         "success": True,
         "parks": [
-            {"name": name, "latitude": latitude, "longitude": longitude}
-            for name, latitude, longitude in results
+            {"name": name, "latitude": latitude, "longitude": longitude, "distance_miles": round(distance, 3)}
+            for name, _, latitude, longitude, distance in results
         ]
     })
 
+# Route: Prometheus metrics
+@app.route("/metrics")
+def metrics_endpoint():
+    """Exposes counters and latency histograms, summed over all workers."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     app.run(debug=True, host="127.0.0.1", port=5002)
\ No newline at end of file
@@ -0,0 +1,135 @@
+import gzip
+import hashlib
+import json
+import threading
+
+from flask import Response
+
+# Cache-Control for responses whose URL carries the version they were built for
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Cache-Control for responses at a fixed URL, e.g. the home page: keep, but check the ETag every time
+REVALIDATE_CACHE_CONTROL = "public, no-cache"
+
+GZIP_LEVEL = 9 # Compressed once per database version, so compress hard
+
+
+class PrecomputedResponse:
+    """
+    A response body built once, kept both plain and gzipped, with a strong ETag per
+    encoding. Serving it is a header check and a buffer copy.
+    """
+    __slots__ = ("body", "gzipped", "etag", "mimetype")
+
+    def __init__(self, body, mimetype):
+        """
+        Args:
+            body (bytes | str): The response body.
+            mimetype (str): Its mimetype.
+        """
+        self.body = body.encode("utf-8") if isinstance(body, str) else body
+        # mtime=0 keeps the gzip bytes, and so their ETag, the same across workers
+        self.gzipped = gzip.compress(self.body, GZIP_LEVEL, mtime=0)
+        self.etag = hashlib.sha256(self.body).hexdigest()[:20]
+        self.mimetype = mimetype
+
+    def respond(self, request, cache_control=REVALIDATE_CACHE_CONTROL):
+        """
+        Answers request with the gzipped body if accepted, or 304 if the client's copy is current.
+
+        Args:
+            request (flask.Request): The request being answered.
+            cache_control (str): The Cache-Control header to send.
+
+        Returns:
+            flask.Response: The response.
+        """
+        use_gzip = "gzip" in request.accept_encodings
+        # Each encoding is a different representation, so it gets its own strong ETag
+        etag = f"{self.etag}-gz" if use_gzip else self.etag
+
+        # If-None-Match uses weak comparison, proxies may have weakened the ETag
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = Response(self.gzipped if use_gzip else self.body, mimetype=self.mimetype)
+            if use_gzip:
+                response.headers["Content-Encoding"] = "gzip"
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = cache_control
+        response.vary.add("Accept-Encoding")
+        return response
+
+
+def parks_geojson(catalog):
+    """
+    Builds a GeoJSON FeatureCollection of the catalog's parks.
+
+    Args:
+        catalog (ReferenceCatalog): The reference data.
+
+    Returns:
+        str: The GeoJSON document.
+    """
+    features = [
+        {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [longitude, latitude]},
+            "properties": {"name": name}
+        }
+        for name, latitude, longitude in catalog.parks
+        if latitude is not None and longitude is not None
+    ]
+    return json.dumps({"type": "FeatureCollection", "features": features}, separators=(",", ":"))
+
+
+def categories_json(catalog):
+    """
+    Builds the JSON list of activity categories and age groups.
+
+    Args:
+        catalog (ReferenceCatalog): The reference data.
+
+    Returns:
+        str: The JSON document.
+    """
+    return json.dumps({"categories": catalog.categories, "age_groups": catalog.age_groups},
+                      separators=(",", ":"))
+
+
+class CatalogAssets:
+    """
+    The reference data responses (parks GeoJSON, categories JSON and the home page)
+    for one version of the database, rebuilt when the catalog is reloaded.
+    """
+
+    def __init__(self, render_index):
+        """
+        Args:
+            render_index (callable): Called with (catalog, assets) to render the home page HTML.
+        """
+        self.render_index = render_index
+        self._catalog = None
+        self._assets = None
+        self._lock = threading.Lock()
+
+    def get(self, catalog):
+        """
+        Returns the assets for catalog, building them on first use of this catalog version.
+
+        Returns:
+            dict: "version" (str), "parks", "categories" and "index" (PrecomputedResponse).
+        """
+        with self._lock:
+            if self._catalog is not catalog:
+                parks = PrecomputedResponse(parks_geojson(catalog), "application/geo+json")
+                categories = PrecomputedResponse(categories_json(catalog), "application/json")
+                assets = {
+                    # Names the content, not the file, so every worker hands out the same URLs
+                    "version": hashlib.sha256(f"{parks.etag}{categories.etag}".encode()).hexdigest()[:12],
+                    "parks": parks,
+                    "categories": categories
+                }
+                assets["index"] = PrecomputedResponse(self.render_index(catalog, assets), "text/html")
+                self._catalog = catalog
+                self._assets = assets
+            return self._assets
@@ -0,0 +1,313 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+from app.aio import background
+from app.database_utils import get_catalog
+from app.db import DB_PATH
+from app.metrics import current_request, start_request
+from app.records import to_json
+from app.scrape import ActivityScraper
+from app.upstream import UpstreamUnavailable
+
+# Defaults, overridable through the environment
+BATCH_MAX_SEARCHES = int(os.environ.get("BATCH_MAX_SEARCHES", 100)) # Filter sets accepted in one batch
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 4)) # Planned queries fetched at once
+BATCH_MAX_PAGES = int(os.environ.get("BATCH_MAX_PAGES", 25)) # Upstream pages per planned query
+
+
+class BatchError(ValueError):
+    """
+    Raised for a batch that cannot be run as given, e.g. too many searches.
+    """
+
+
+def _as_list(value):
+    if value is None or value == "":
+        return []
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+def _as_number(value, cast):
+    try:
+        return cast(value) if value not in (None, "") else None
+    except (TypeError, ValueError):
+        raise BatchError(f"Not a number: {value!r}")
+
+
+def build_search(spec):
+    """
+    Sets up a scraper for one filter set, without fetching. Takes the search form's
+    fields, as single values or lists: parks, categories, age_groups, open_slots,
+    min_age, max_age, days_of_week, and distance with user_lat/user_lon.
+
+    Returns:
+        ActivityScraper: The scraper, resolved to park, category and age group ids.
+    """
+    if not isinstance(spec, dict):
+        raise BatchError("Each search must be an object of filters")
+    latitude = _as_number(spec.get("user_lat"), float)
+    longitude = _as_number(spec.get("user_lon"), float)
+    open_slots = _as_number(spec.get("open_slots"), int)
+    return ActivityScraper(
+        distance_miles=_as_number(spec.get("distance"), float),
+        parks=_as_list(spec.get("parks")),
+        categories=_as_list(spec.get("categories")),
+        age_groups=_as_list(spec.get("age_groups")),
+        open_slots=1 if open_slots is None else open_slots,
+        location=(latitude, longitude),
+        min_age=_as_number(spec.get("min_age"), int),
+        max_age=_as_number(spec.get("max_age"), int),
+        days_of_week=_as_list(spec.get("days_of_week"))
+    )
+
+
+def _union(first, second):
+    # An empty list means no filter, i.e. everything
+    if not first or not second:
+        return []
+    return sorted(set(first) | set(second))
+
+
+def plan_queries(searches):
+    """
+    Merges searches into as few upstream queries as possible without fetching much
+    that no search asked for. Searches are first split by the filters results cannot
+    be split on locally (age groups, ages, days, and open slots, since upstream does
+    not report open spots reliably). Within those, searches with the
+    same categories share one query over the union of their parks, then queries with
+    the same parks share one over the union of their categories. Merging parks and
+    categories at once would also fetch the combinations nobody asked for.
+
+    Args:
+        searches (list): ActivityScraper per search, from build_search.
+
+    Returns:
+        list: Queries as dicts of "parks" and "categories" (ids), the shared filters
+              including "open_slots", and "searches" (indexes).
+    """
+    queries = []
+    by_categories = {}
+    for index, search in enumerate(searches):
+        if search.no_matching_parks:
+            continue
+        shared = (tuple(sorted(search.age_groups)), search.min_age, search.max_age, search.days_of_week,
+                  search.open_slots)
+        key = (shared, tuple(sorted(search.categories)))
+        query = by_categories.get(key)
+        if query is None:
+            query = by_categories[key] = {
+                "parks": sorted(search.parks),
+                "categories": sorted(search.categories),
+                "open_slots": search.open_slots,
+                "age_groups": sorted(search.age_groups),
+                "min_age": search.min_age,
+                "max_age": search.max_age,
+                "days_of_week": search.days_of_week,
+                "searches": []
+            }
+            queries.append(query)
+        else:
+            query["parks"] = _union(query["parks"], search.parks)
+        query["searches"].append(index)
+
+    merged = {}
+    for query in queries:
+        shared = (tuple(query["age_groups"]), query["min_age"], query["max_age"], query["days_of_week"],
+                  query["open_slots"])
+        key = (shared, tuple(query["parks"]))
+        existing = merged.get(key)
+        if existing is None:
+            merged[key] = query
+        else:
+            existing["categories"] = _union(existing["categories"], query["categories"])
+            existing["searches"].extend(query["searches"])
+    return list(merged.values())
+
+
+def query_scraper(query):
+    """
+    Sets up a scraper for a planned query, with ids already resolved.
+    """
+    scraper = ActivityScraper(open_slots=query["open_slots"], min_age=query["min_age"],
+                              max_age=query["max_age"], days_of_week=query["days_of_week"])
+    scraper.parks = query["parks"]
+    scraper.categories = query["categories"]
+    scraper.age_groups = query["age_groups"]
+    return scraper
+
+
+async def fetch_all(scraper, max_pages=BATCH_MAX_PAGES):
+    """
+    Fetches batches of pages into scraper.activities until the results end or max_pages.
+    Leaves scraper.more_results_to_fetch set if results were cut short, and scraper.degraded
+    too if upstream failed on a page after the first, keeping the pages fetched before it.
+
+    Raises:
+        UpstreamUnavailable: If upstream failed on the query's first page.
+    """
+    while True:
+        scraper.more_results_to_fetch = False
+        scraper.next_page = None
+        # Batches start wherever the last one stopped, so the last may need trimming to max_pages
+        scraper.MAX_PAGES_PER_SCRAPE = min(ActivityScraper.MAX_PAGES_PER_SCRAPE, max_pages - scraper.first_page + 1)
+        try:
+            await scraper.get_activities_async()
+        except UpstreamUnavailable:
+            if scraper.first_page == 1:
+                raise
+            # The page upstream failed on again, when retried as a batch's first
+            scraper.more_results_to_fetch = True
+            scraper.next_page = scraper.first_page
+            scraper.degraded = True
+            return
+        if not scraper.more_results_to_fetch or scraper.next_page > max_pages:
+            return
+        # A batch cut short by upstream goes on from the page that failed
+        scraper.first_page = scraper.next_page
+
+
+async def fetch_queries(scrapers, concurrency=BATCH_CONCURRENCY, max_pages=BATCH_MAX_PAGES):
+    """
+    Fetches every query's results, at most concurrency queries at a time. A query
+    upstream failed outright comes back empty, degraded and with more results to fetch.
+
+    Raises:
+        UpstreamUnavailable: If every query failed outright.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(scraper):
+        async with semaphore:
+            await fetch_all(scraper, max_pages)
+
+    # Every query runs to its end, one failing does not leave the others running unwatched
+    outcomes = await asyncio.gather(*(fetch(scraper) for scraper in scrapers), return_exceptions=True)
+    failures = [outcome for outcome in outcomes if isinstance(outcome, BaseException)]
+    for failure in failures:
+        if not isinstance(failure, UpstreamUnavailable):
+            raise failure
+    if failures and len(failures) == len(scrapers):
+        raise failures[0]
+
+    for scraper, outcome in zip(scrapers, outcomes):
+        if isinstance(outcome, UpstreamUnavailable):
+            scraper.more_results_to_fetch = True
+            scraper.degraded = True
+
+
+def split_results(search, query, activities):
+    """
+    Picks a search's own activities out of its query's results. Activities at a park
+    or in a category the catalog does not know cannot be placed, so every search of
+    the query keeps them rather than none.
+
+    Args:
+        search (ActivityScraper): The search, from build_search.
+        query (dict): The planned query it was part of.
+        activities (list): The query's activities.
+
+    Returns:
+        list: The search's activities.
+    """
+    catalog = get_catalog(DB_PATH)
+    parks = set(search.parks)
+    categories = set(search.categories)
+    # If nothing was merged in, upstream already applied the search's own filter
+    parks_merged = set(query["parks"]) != parks
+    categories_merged = set(query["categories"]) != categories
+
+    def wanted(activity):
+        if parks and parks_merged:
+            park_id = catalog.park_ids.get(activity.location)
+            if park_id is not None and park_id not in parks:
+                return False
+        if categories and categories_merged:
+            category_id = catalog.activity_ids.get(activity.category)
+            if category_id is not None and category_id not in categories:
+                return False
+        return True
+
+    return [activity for activity in activities if wanted(activity)]
+
+
+def run_batch(specs, concurrency=BATCH_CONCURRENCY, max_pages=BATCH_MAX_PAGES):
+    """
+    Runs many searches, fetching the results they share once.
+
+    Args:
+        specs (list): Filter sets, see build_search. An "id" in one is echoed back.
+        concurrency (int): Planned queries fetched at once.
+        max_pages (int): Upstream pages per planned query.
+
+    Returns:
+        dict: "searches" (per search: id, grouped activities, more_results_to_fetch),
+              "queries" (number of upstream queries planned) and "upstream_pages".
+    """
+    if not isinstance(specs, list) or not specs:
+        raise BatchError("Expected a non-empty list of searches")
+    if len(specs) > BATCH_MAX_SEARCHES:
+        raise BatchError(f"At most {BATCH_MAX_SEARCHES} searches per batch")
+
+    searches = [build_search(spec) for spec in specs]
+    queries = plan_queries(searches)
+    scrapers = [query_scraper(query) for query in queries]
+
+    request_metrics = current_request() or start_request()
+    pages_before = request_metrics.upstream_pages
+    background.run(fetch_queries(scrapers, concurrency, max_pages))
+
+    results = [None] * len(specs)
+    for query, scraper in zip(queries, scrapers):
+        for index in query["searches"]:
+            search = searches[index]
+            search.activities = split_results(search, query, scraper.activities)
+            # Groups per search, nearest park first when it has a location
+            search.dedeup_activities()
+            results[index] = (search.activities, scraper.more_results_to_fetch, scraper.degraded)
+
+    return {
+        "searches": [
+            {
+                "id": spec.get("id", index),
+                "activities": result[0] if result else [],
+                "more_results_to_fetch": result[1] if result else False,
+                "degraded": result[2] if result else False
+            }
+            for index, (spec, result) in enumerate(zip(specs, results))
+        ],
+        "queries": len(queries),
+        "upstream_pages": request_metrics.upstream_pages - pages_before
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run many searches at once, fetching shared results once.")
+    parser.add_argument("input", nargs="?", help="JSON file with a list of searches (or {\"searches\": [...]}), "
+                                                 "standard input if omitted")
+    parser.add_argument("--output", help="Write the results here instead of standard output")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help="Queries fetched at once")
+    parser.add_argument("--max-pages", type=int, default=BATCH_MAX_PAGES, help="Upstream pages per query")
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input) as f:
+            specs = json.load(f)
+    else:
+        specs = json.load(sys.stdin)
+    if isinstance(specs, dict):
+        specs = specs.get("searches")
+
+    try:
+        result = run_batch(specs, args.concurrency, args.max_pages)
+    except BatchError as e:
+        sys.exit(f"Batch failed: {e}")
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(to_json(result))
+    else:
+        print(to_json(result))
+    print(f"{len(result['searches'])} searches, {result['queries']} queries, "
+          f"{result['upstream_pages']} upstream pages", file=sys.stderr)
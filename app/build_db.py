@@ -0,0 +1,171 @@
+import argparse
+import ast
+import csv
+import os
+import sqlite3
+import struct
+import time
+
+from app.db import DB_PATH
+from app.migrate import migrate
+
+PARKS_CSV = "data/parks.csv"
+ACTIVITIES_CSV = "data/activities.csv"
+
+WKB_POINT = 1 # WKB geometry type of a point
+SRID_PREFIX_SIZE = 4 # parks.csv blobs start with a 4-byte SRID before the WKB itself
+
+SCHEMA = """
+CREATE TABLE parks (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    city_id INTEGER NOT NULL,
+    latitude REAL,
+    longitude REAL
+);
+CREATE TABLE activities (
+    type TEXT NOT NULL,
+    name TEXT NOT NULL,
+    city_id INTEGER NOT NULL
+);
+"""
+
+
+def decode_wkb_point(blob):
+    """
+    Decodes a WKB point, optionally preceded by a 4-byte SRID, without SpatiaLite.
+
+    Args:
+        blob (bytes): The geometry, e.g. 00000000 01 01000000 <x double> <y double>.
+
+    Returns:
+        tuple: (latitude, longitude), i.e. (y, x).
+    """
+    if len(blob) == SRID_PREFIX_SIZE + 21:
+        blob = blob[SRID_PREFIX_SIZE:]
+    if len(blob) != 21:
+        raise ValueError(f"Not a WKB point: {len(blob)} bytes")
+
+    byte_order = "<" if blob[0] == 1 else ">"
+    (geometry_type,) = struct.unpack(f"{byte_order}I", blob[1:5])
+    if geometry_type != WKB_POINT:
+        raise ValueError(f"Not a WKB point: geometry type {geometry_type}")
+    x, y = struct.unpack(f"{byte_order}dd", blob[5:21])
+    return y, x
+
+
+def parse_blob(text):
+    """
+    Turns a stringified Python bytes literal (b'\\x00...') from the CSV back into bytes.
+    """
+    blob = ast.literal_eval(text)
+    if not isinstance(blob, bytes):
+        raise ValueError("Not a bytes literal")
+    return blob
+
+
+def clean_name(name):
+    """
+    Strips the byte order mark and stray whitespace spreadsheet exports leave in names.
+    """
+    return name.replace("\ufeff", "").strip()
+
+
+def read_parks(path=PARKS_CSV):
+    """
+    Reads parks.csv, taking coordinates from the WKB location and falling back to
+    the latitude/longitude columns where it is missing or unreadable.
+
+    Returns:
+        list: Rows of (id, name, city_id, latitude, longitude).
+    """
+    rows = []
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        for row in csv.DictReader(f):
+            try:
+                latitude, longitude = decode_wkb_point(parse_blob(row["location"]))
+            except (ValueError, SyntaxError, struct.error):
+                latitude = float(row["latitude"]) if row.get("latitude") else None
+                longitude = float(row["longitude"]) if row.get("longitude") else None
+            rows.append((int(row["id"]), clean_name(row["name"]), int(row["city_id"]), latitude, longitude))
+    return rows
+
+
+def read_activities(path=ACTIVITIES_CSV):
+    """
+    Reads activities.csv.
+
+    Returns:
+        list: Rows of (type, name, city_id).
+    """
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        return [
+            (clean_name(row["type"]), clean_name(row["activity"]), int(row["city_id"]))
+            for row in csv.DictReader(f)
+        ]
+
+
+def build_database(db_path=DB_PATH, parks_csv=PARKS_CSV, activities_csv=ACTIVITIES_CSV):
+    """
+    Builds the activities database from the CSVs into a temporary file, then moves
+    it into place in one step, so running workers switch over to a complete file.
+
+    Args:
+        db_path (str): Where to write the database.
+        parks_csv (str): Path to parks.csv.
+        activities_csv (str): Path to activities.csv.
+
+    Returns:
+        tuple: (number of parks, number of activities).
+    """
+    parks = read_parks(parks_csv)
+    activities = read_activities(activities_csv)
+
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    tmp_path = f"{db_path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    try:
+        conn = sqlite3.connect(tmp_path)
+        try:
+            conn.execute("PRAGMA journal_mode = OFF") # Nothing to recover, a failed build is thrown away
+            conn.execute("PRAGMA synchronous = OFF")
+            with conn:
+                conn.executescript(SCHEMA)
+                conn.executemany("INSERT INTO parks VALUES (?, ?, ?, ?, ?)", parks)
+                conn.executemany("INSERT INTO activities VALUES (?, ?, ?)", activities)
+        finally:
+            conn.close()
+
+        # Indexes, R*Tree and precomputed lists come from the same migrations existing databases get
+        migrate(tmp_path)
+
+        conn = sqlite3.connect(tmp_path)
+        try:
+            conn.execute("ANALYZE")
+            conn.execute("VACUUM")
+            # Readers open the file read-only, no WAL files next to it
+            conn.execute("PRAGMA journal_mode = DELETE")
+        finally:
+            conn.close()
+
+        os.replace(tmp_path, db_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return len(parks), len(activities)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the activities database from data/*.csv.")
+    parser.add_argument("--db", default=DB_PATH, help="Path of the database to write")
+    parser.add_argument("--parks", default=PARKS_CSV, help="Path to parks.csv")
+    parser.add_argument("--activities", default=ACTIVITIES_CSV, help="Path to activities.csv")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    park_count, activity_count = build_database(args.db, args.parks, args.activities)
+    print(f"Built {args.db} with {park_count} parks and {activity_count} categories/age groups "
+          f"in {time.perf_counter() - start:.2f}s")
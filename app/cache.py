@@ -0,0 +1,209 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from app.db import write_connection
+
+# Defaults, overridable through the environment
+PAGE_CACHE_TTL = int(os.environ.get("PAGE_CACHE_TTL", 300)) # Seconds a cached page stays fresh
+PAGE_CACHE_SIZE = int(os.environ.get("PAGE_CACHE_SIZE", 2048)) # Max number of cached pages
+PAGE_CACHE_PATH = os.environ.get("PAGE_CACHE_PATH") # Set to a file path to share the cache across workers
+PAGE_CACHE_STALE = int(os.environ.get("PAGE_CACHE_STALE", 3600)) # Seconds expired pages are kept for when upstream is down
+
+LRU_TOUCH_INTERVAL = 10 # Seconds; a hit only rewrites last_used when it is older, so hot keys don't write on every read
+
+
+class TTLCache:
+    """
+    An in-process cache with a per-entry time to live and least-recently-used eviction.
+    Expired entries are kept for another stale_ttl seconds, for get(key, allow_stale=True).
+    Safe to share between threads of one worker.
+    """
+    blocking = False # Whether calls can wait on other processes, see SQLiteTTLCache
+
+    def __init__(self, ttl=PAGE_CACHE_TTL, max_entries=PAGE_CACHE_SIZE, stale_ttl=0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, allow_stale=False):
+        """
+        Returns the cached value for key, or None if missing or expired. With allow_stale,
+        entries expired less than stale_ttl seconds ago are returned too.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] + self.stale_ttl < now:
+                del self._entries[key]
+                entry = None
+            if entry is None or (entry[0] < now and not allow_stale):
+                self.misses += 1
+                return None
+
+            # Mark as most recently used
+            self._entries.move_to_end(key)
+            if entry[0] < now:
+                self.stale_hits += 1
+            else:
+                self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores value under key, evicting the least recently used entries if over capacity.
+        """
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """
+        Removes key from the cache if present.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Returns hit/miss counters and current size.
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "stale_hits": self.stale_hits, "size": len(self._entries)}
+
+
+class SQLiteTTLCache:
+    """
+    A TTL + LRU cache stored in a local SQLite file, so every gunicorn worker on the
+    host shares the same entries. Values are stored as JSON unless other dumps/loads are given.
+    Expired entries are kept for another stale_ttl seconds, as in TTLCache.
+    """
+    blocking = True # Writes wait for the file's write lock, which another worker may hold
+
+    def __init__(self, path, ttl=PAGE_CACHE_TTL, max_entries=PAGE_CACHE_SIZE, table="cache",
+                 dumps=None, loads=json.loads, stale_ttl=0):
+        self.path = path
+        self.dumps = dumps or (lambda value: json.dumps(value, separators=(",", ":")))
+        self.loads = loads
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stale_ttl = stale_ttl
+        self.table = table
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self._lock = threading.Lock()
+
+        with self._connect() as conn:
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {self.table} (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_last_used ON {self.table}(last_used)")
+
+    def _connect(self):
+        """
+        Returns this thread's connection to the cache file, opening it on first use.
+        """
+        return write_connection(self.path, per_thread=True)
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, key, allow_stale=False):
+        """
+        Returns the cached value for key, or None if missing or expired. With allow_stale,
+        entries expired less than stale_ttl seconds ago are returned too.
+        """
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute(f"SELECT value, expires_at, last_used FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] + self.stale_ttl < now or (row[1] < now and not allow_stale):
+            self._count("misses")
+            return None
+
+        if now - row[2] > LRU_TOUCH_INTERVAL:
+            conn.execute(f"UPDATE {self.table} SET last_used = ? WHERE key = ?", (now, key))
+        self._count("stale_hits" if row[1] < now else "hits")
+        return self.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores value under key, evicting expired and least recently used entries if over capacity.
+        """
+        conn = self._connect()
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, self.dumps(value), expires_at, now)
+            )
+            (size,) = conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()
+            if size > self.max_entries:
+                conn.execute(f"DELETE FROM {self.table} WHERE expires_at < ?", (now - self.stale_ttl,))
+                conn.execute(f"""
+                    DELETE FROM {self.table} WHERE key IN (
+                        SELECT key FROM {self.table} ORDER BY last_used
+                        LIMIT MAX((SELECT COUNT(*) FROM {self.table}) - ?, 0)
+                    )
+                """, (self.max_entries,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def delete(self, key):
+        """
+        Removes key from the cache if present.
+        """
+        self._connect().execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def clear(self):
+        self._connect().execute(f"DELETE FROM {self.table}")
+
+    def stats(self):
+        """
+        Returns this worker's hit/miss counters and the shared cache size.
+        """
+        (size,) = self._connect().execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "stale_hits": self.stale_hits, "size": size}
+
+
+def build_page_cache(path=PAGE_CACHE_PATH, ttl=PAGE_CACHE_TTL, max_entries=PAGE_CACHE_SIZE, stale_ttl=PAGE_CACHE_STALE):
+    """
+    Builds the upstream page cache: shared on disk if a path is given, otherwise in-process.
+
+    Args:
+        path (str): Optional SQLite file to share the cache across workers.
+        ttl (int): Seconds each cached page stays fresh.
+        max_entries (int): Max number of cached pages before LRU eviction.
+        stale_ttl (int): Seconds expired pages are kept to fall back on when upstream is down.
+
+    Returns:
+        TTLCache or SQLiteTTLCache: The cache instance.
+    """
+    if path:
+        return SQLiteTTLCache(path, ttl=ttl, max_entries=max_entries, table="page_cache", stale_ttl=stale_ttl)
+    return TTLCache(ttl=ttl, max_entries=max_entries, stale_ttl=stale_ttl)
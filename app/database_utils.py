@@ -1,8 +1,86 @@
+import os
 import sqlite3
+import threading
+from types import MappingProxyType
 
-# Database Path
-DB_PATH = "data/chicago_activities.db"
+from app.db import DB_PATH, read_connection
+from app.metrics import timed
 
+
+class ReferenceCatalog:
+    """
+    Read-only copy of the static reference data (parks, categories, age groups),
+    loaded once per worker so requests never query SQLite for it.
+    """
+    __slots__ = ("mtime", "parks", "park_ids", "park_coordinates", "activity_ids", "categories", "age_groups")
+
+    def __init__(self, mtime, parks, activities, lists=None):
+        """
+        Args:
+            mtime (float): Modification time of the database file the data was read from.
+            parks (list): Rows of (name, city_id, latitude, longitude).
+            activities (list): Rows of (type, name, city_id).
+            lists (list): Optional precomputed rows of (kind, name), sorted by name within kind.
+        """
+        self.mtime = mtime
+
+        # Park rows in table order, as (name, latitude, longitude)
+        self.parks = tuple((name, lat, lon) for name, _, lat, lon in parks)
+        self.park_ids = MappingProxyType({name: city_id for name, city_id, _, _ in parks})
+        self.park_coordinates = MappingProxyType({name: (lat, lon) for name, _, lat, lon in parks})
+
+        # Categories and age groups share the activities table
+        self.activity_ids = MappingProxyType({name: city_id for _, name, city_id in activities})
+        if lists is not None:
+            self.categories = tuple(name for kind, name in lists if kind == "category")
+            self.age_groups = tuple(name for kind, name in lists if kind == "age_group")
+        else:
+            self.categories = tuple(sorted({name for _type, name, _ in activities if _type == "ActivityOtherCategoryID"}))
+            self.age_groups = tuple(sorted({name for _type, name, _ in activities if _type == "ActivityCategoryID"}))
+
+    def ids(self, db_table):
+        """
+        Returns the name -> city_id map for "parks" or "activities".
+        """
+        return self.park_ids if db_table == "parks" else self.activity_ids
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog(db_path=DB_PATH):
+    """
+    Returns the reference catalog, reloading it if the database file changed on disk.
+
+    Args:
+        db_path (str): Path to the activities database.
+
+    Returns:
+        ReferenceCatalog: The current catalog.
+    """
+    global _catalog
+    mtime = os.stat(db_path).st_mtime
+    catalog = _catalog
+    if catalog is not None and catalog.mtime == mtime:
+        return catalog
+
+    with _catalog_lock:
+        # Another thread may have reloaded it while we waited
+        if _catalog is None or _catalog.mtime != mtime:
+            conn = read_connection(db_path)
+            parks = conn.execute("SELECT name, city_id, latitude, longitude FROM parks").fetchall()
+            activities = conn.execute("SELECT type, name, city_id FROM activities").fetchall()
+            try:
+                lists = conn.execute("SELECT kind, name FROM reference_lists ORDER BY kind, name").fetchall()
+            except sqlite3.OperationalError:
+                # Database from before the lists were precomputed (see app.migrate)
+                lists = None
+            _catalog = ReferenceCatalog(mtime, parks, activities, lists)
+        return _catalog
+
+
+@timed("db")
 def db_names_to_ids(names, db_table):
     """
     Finds park IDs that match a list of park names.
@@ -14,17 +92,8 @@ def db_names_to_ids(names, db_table):
     Returns:
         list: List of matching park IDs.
     """
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    
-    # Placeholders - each ? is a park to find
-    placeholders = ','.join(['?'] * len(names))
-    
-    # Get and return IDs ("city_id"), flattened as list
-    cur.execute(f"SELECT city_id FROM {db_table} WHERE name IN ({placeholders})", names)
-    output = [row[0] for row in cur.fetchall()]
-    conn.close()
-    return output
+    ids = get_catalog(DB_PATH).ids(db_table)
+    return [ids[name] for name in names if name in ids]
 
 
 def clean_park_facility_name(name):
@@ -48,25 +117,24 @@ def clean_park_facility_name(name):
     return name
 
 
+@timed("activity_parks")
 def get_activity_parks(activities):
     """
     Maps activities to their corresponding parks and retrieves park coordinates.
 
     Args:
-        activities (list): List of activity dictionaries, each containing a 'location' key.
+        activities (list): List of activity records, each with a location.
 
     Returns:
         list: A list of tuples containing (park name, latitude, longitude, list of associated activity names).
     """
-    # Connect to the database
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    park_coordinates = get_catalog(DB_PATH).park_coordinates
 
     # Create a mapping from park location name to list of activity names
     park_activity_map = {}
 
     for activity in activities:
-        location = activity.get("location")
+        location = activity.location
         if location:
             if location not in park_activity_map:
                 # If the fetched activity has a location returned,
@@ -74,26 +142,13 @@ def get_activity_parks(activities):
                 park_activity_map[location] = []
             
             # Add activity to list of activities for that location
-            park_activity_map[location].append(activity["name"])
-
-    # Prepare the list of park names to query
-    park_names = list(park_activity_map.keys())
-    placeholders = ",".join("?" for _ in park_names)
-
-    # Fetch park latitude and longitude for each park name
-    cursor.execute(f"""
-        SELECT name, latitude, longitude
-        FROM parks
-        WHERE name IN ({placeholders})
-    """, park_names)
+            park_activity_map[location].append(activity.name)
 
     # Build results with park name, coordinates, and associated activities
     results = []
-    for name, lat, lon in cursor.fetchall():
-        act_names = park_activity_map.get(name, [])
-        results.append((name, lat, lon, act_names))
-
-    # Close the database connection
-    conn.close()
+    for name, act_names in park_activity_map.items():
+        if name in park_coordinates:
+            lat, lon = park_coordinates[name]
+            results.append((name, lat, lon, act_names))
 
     return results
@@ -0,0 +1,99 @@
+import os
+import sqlite3
+import threading
+
+# Database Path
+DB_PATH = os.environ.get("DB_PATH", "data/chicago_activities.db")
+
+# Set DB_IMMUTABLE=1 when the database file is never written while the app runs
+# (e.g. baked into the image), so readers can skip locking entirely
+DB_IMMUTABLE = os.environ.get("DB_IMMUTABLE") == "1"
+
+STATEMENT_CACHE_SIZE = 256 # Compiled statements kept per connection
+READ_PRAGMAS = (
+    "PRAGMA mmap_size = 268435456", # Map up to 256MB of the file instead of copying pages
+    "PRAGMA cache_size = -16000", # 16MB page cache per connection
+    "PRAGMA temp_store = MEMORY",
+)
+WRITE_PRAGMAS = (
+    "PRAGMA journal_mode = WAL", # Readers keep working while a writer commits
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+)
+
+_local = threading.local()
+
+
+def _file_version(db_path):
+    """
+    Identifies the current database file, so connections notice when it is replaced.
+    """
+    stat = os.stat(db_path)
+    return stat.st_ino, stat.st_mtime_ns
+
+
+def read_connection(db_path=DB_PATH):
+    """
+    Returns this thread's read-only connection to the database, opening it on first use
+    and reopening it if the file was rebuilt since.
+
+    Args:
+        db_path (str): Path to the database.
+
+    Returns:
+        sqlite3.Connection: A read-only connection with tuned pragmas and a statement cache.
+    """
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    version = _file_version(db_path)
+    entry = connections.get(db_path)
+    if entry is not None:
+        conn, conn_version = entry
+        if conn_version == version:
+            return conn
+        conn.close()
+
+    uri = f"file:{os.path.abspath(db_path)}?mode=ro"
+    if DB_IMMUTABLE:
+        uri += "&immutable=1"
+    conn = sqlite3.connect(uri, uri=True, cached_statements=STATEMENT_CACHE_SIZE)
+    for pragma in READ_PRAGMAS:
+        conn.execute(pragma)
+
+    connections[db_path] = (conn, version)
+    return conn
+
+
+def write_connection(db_path=DB_PATH, per_thread=False):
+    """
+    Opens a new writable connection in WAL mode. Callers are responsible for closing it.
+
+    With per_thread, returns this thread's connection to db_path instead, opened on
+    first use and again in a forked child, which must not use its parent's. It is
+    kept open and runs in autocommit mode, so callers open their own transactions
+    (e.g. BEGIN IMMEDIATE) for state shared between workers.
+
+    Args:
+        db_path (str): Path to the database.
+        per_thread (bool): Reuse this thread's autocommit connection.
+
+    Returns:
+        sqlite3.Connection: A writable connection.
+    """
+    if per_thread:
+        connections = getattr(_local, "write_connections", None)
+        if connections is None or getattr(_local, "pid", None) != os.getpid():
+            connections = _local.write_connections = {}
+            _local.pid = os.getpid()
+        conn = connections.get(db_path)
+        if conn is None:
+            conn = connections[db_path] = write_connection(db_path)
+            conn.isolation_level = None
+        return conn
+
+    conn = sqlite3.connect(db_path, cached_statements=STATEMENT_CACHE_SIZE)
+    for pragma in WRITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
@@ -0,0 +1,292 @@
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+import threading
+import zlib
+
+from app.batch import build_search
+from app.grouping import ActivityGrouper
+from app.records import to_json
+from app.upstream import UpstreamUnavailable
+
+# Defaults, overridable through the environment
+EXPORT_MAX_PAGES = int(os.environ.get("EXPORT_MAX_PAGES", 5000)) # Upstream pages per export, 100,000 sessions
+EXPORT_CONCURRENCY = int(os.environ.get("EXPORT_CONCURRENCY", 2)) # Exports streamed at once per worker
+
+EXPORT_FORMATS = ("ndjson", "csv")
+
+# Exports in progress in this worker. Each can crawl thousands of pages through the upstream
+# rate limit interactive searches share, so only a few run at a time
+export_slots = threading.BoundedSemaphore(EXPORT_CONCURRENCY)
+
+# One CSV row per session, with its activity's details repeated
+CSV_COLUMNS = ("name", "location", "category", "age_description", "date_range", "time_range", "days",
+               "action_link", "detail_link")
+
+
+class GroupStream:
+    """
+    Groups sessions arriving page by page in upstream's name order, handing out each
+    group as soon as no later page can add to it. Only the groups of the name at the
+    end of the last page are held, so memory does not grow with the export.
+    """
+
+    def __init__(self):
+        self.grouper = ActivityGrouper()
+        self.pending_name = None
+        self.pending_since = None # (page, index on page) of the first session still held
+        self.groups_done = 0
+        self.sessions_done = 0
+
+    def add(self, page_num, activities, offset=0):
+        """
+        Adds a page of activities.
+
+        Args:
+            page_num (int): The page they came from.
+            activities (list): The page's activities, in upstream order.
+            offset (int): Activities of the page skipped before these, when resuming.
+
+        Returns:
+            list: Groups that are complete, as ActivityGroup.
+        """
+        if not activities:
+            return []
+        self.grouper.add(activities)
+
+        last_name = activities[-1].name
+        if last_name != self.pending_name:
+            # Names arrive together, so the held name starts where its run on this page starts
+            first = next(index for index, activity in enumerate(activities) if activity.name == last_name)
+            self.pending_name = last_name
+            self.pending_since = (page_num, offset + first)
+
+        done = [key for key in self.grouper.order if self.grouper.groups[key]["info"]["name"] != last_name]
+        return self._take(done)
+
+    def finish(self):
+        """
+        Returns the groups still held, at the end of the results.
+        """
+        self.pending_name = self.pending_since = None
+        return self._take(list(self.grouper.order))
+
+    def _take(self, keys):
+        groups = self.grouper.grouped(keys)
+        for key in keys:
+            del self.grouper.groups[key]
+        taken = set(keys)
+        self.grouper.order = [key for key in self.grouper.order if key not in taken]
+        self.groups_done += len(groups)
+        self.sessions_done += sum(len(group.date_ranges) for group in groups)
+        return groups
+
+    def checkpoint(self, next_page):
+        """
+        Where to resume so that exactly the groups not yet handed out are produced again.
+
+        Args:
+            next_page (int): The page after the last one added, None once the results have ended.
+
+        Returns:
+            dict: "page" and "skip" (activities of that page already handed out), plus counts.
+        """
+        page, skip = self.pending_since or (next_page, 0)
+        return {"page": page, "skip": skip, "groups": self.groups_done, "sessions": self.sessions_done}
+
+
+def iter_export_pages(scraper, first_page=1, max_pages=EXPORT_MAX_PAGES):
+    """
+    Pages through every result of a search, one scraper batch at a time, yielding
+    (page number, activities). Nothing is kept once the page has been handed out.
+
+    Raises:
+        UpstreamUnavailable: If upstream failed partway, the export can resume from its checkpoint.
+    """
+    page_num = first_page
+    while page_num <= max_pages:
+        scraper.first_page = page_num
+        scraper.more_results_to_fetch = False
+        for activities in scraper.iter_pages():
+            scraper.activities = []
+            yield page_num, activities
+            page_num += 1
+        if scraper.more_results_to_fetch and scraper.degraded:
+            raise UpstreamUnavailable(f"Upstream failed at page {page_num}")
+        if not scraper.more_results_to_fetch:
+            return
+
+
+def format_header(export_format):
+    if export_format == "csv":
+        return format_csv_rows([CSV_COLUMNS])
+    return ""
+
+
+def format_csv_rows(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+
+def format_groups(groups, export_format):
+    """
+    Formats groups as NDJSON (one group per line) or CSV (one session per row).
+    """
+    if export_format == "csv":
+        return format_csv_rows(
+            (group.name, group.location, group.category, group.age_description,
+             date_range, time_range, days, action_link, detail_link)
+            for group in groups
+            for date_range, time_range, days, action_link, detail_link in zip(
+                group.date_ranges, group.time_ranges, group.days, group.action_links, group.detail_links)
+        )
+    return "".join(to_json(group) + "\n" for group in groups)
+
+
+def export_chunks(scraper, export_format="ndjson", first_page=1, skip=0, header=True, max_pages=EXPORT_MAX_PAGES):
+    """
+    Exports every result of a search, grouped, as text chunks in name order.
+
+    Args:
+        scraper (ActivityScraper): The search, set up but not yet fetched.
+        export_format (str): "ndjson" or "csv".
+        first_page (int): Page to start at, from a checkpoint.
+        skip (int): Activities of first_page already exported, from a checkpoint.
+        header (bool): Whether to start with the CSV header.
+        max_pages (int): Last page to fetch.
+
+    Yields:
+        tuple: (text, checkpoint after it, see GroupStream.checkpoint), the last with page None.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {export_format}")
+    # A full export would only push other searches' pages out of the page cache
+    scraper.use_cache = False
+
+    stream = GroupStream()
+    if header:
+        yield format_header(export_format), stream.checkpoint(first_page)
+    for page_num, activities in iter_export_pages(scraper, first_page, max_pages):
+        offset = skip if page_num == first_page else 0
+        groups = stream.add(page_num, activities[offset:], offset)
+        yield format_groups(groups, export_format), stream.checkpoint(page_num + 1)
+    groups = stream.finish()
+    yield format_groups(groups, export_format), stream.checkpoint(None)
+
+
+def gzip_stream(chunks):
+    """
+    Gzips text chunks on the fly, flushing after each so a client receives them as they are made.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) # wbits=31 writes a gzip header
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8")) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def checkpoint_path(output):
+    return f"{output}.checkpoint"
+
+
+def export_to_file(scraper, search, output, export_format="ndjson", use_gzip=False, resume=False,
+                   max_pages=EXPORT_MAX_PAGES):
+    """
+    Exports a search to a file, checkpointing after every page. Gzip output is written
+    as one gzip member per page, so it can be cut back to any checkpoint and appended to.
+
+    Args:
+        scraper (ActivityScraper): The search, set up but not yet fetched.
+        search (dict): The search's filters, stored in the checkpoint to check a resume against.
+        output (str): Path of the file to write.
+        export_format (str): "ndjson" or "csv".
+        use_gzip (bool): Whether to gzip the output.
+        resume (bool): Continue from output's checkpoint, if there is one.
+        max_pages (int): Last page to fetch.
+
+    Returns:
+        dict: Groups and sessions written.
+    """
+    state = None
+    if resume and os.path.exists(checkpoint_path(output)):
+        with open(checkpoint_path(output)) as f:
+            state = json.load(f)
+        if state["search"] != search or state["format"] != export_format or state["gzip"] != use_gzip:
+            raise ValueError("The checkpoint belongs to a different export")
+
+    with open(output, "r+b" if state else "wb") as f:
+        if state:
+            # Drop anything written after the checkpoint
+            f.truncate(state["offset"])
+            f.seek(state["offset"])
+        groups_before = state["groups"] if state else 0
+        sessions_before = state["sessions"] if state else 0
+
+        chunks = export_chunks(scraper, export_format,
+                               first_page=state["page"] if state else 1,
+                               skip=state["skip"] if state else 0,
+                               header=state is None, max_pages=max_pages)
+        for text, checkpoint in chunks:
+            if text:
+                data = text.encode("utf-8")
+                f.write(gzip.compress(data, mtime=0) if use_gzip else data)
+                f.flush()
+            state = {
+                "search": search,
+                "format": export_format,
+                "gzip": use_gzip,
+                "page": checkpoint["page"],
+                "skip": checkpoint["skip"],
+                "offset": f.tell(),
+                "groups": groups_before + checkpoint["groups"],
+                "sessions": sessions_before + checkpoint["sessions"]
+            }
+            if checkpoint["page"] is not None:
+                write_checkpoint(output, state)
+
+    # Complete, nothing left to resume
+    if os.path.exists(checkpoint_path(output)):
+        os.remove(checkpoint_path(output))
+    return {"groups": state["groups"], "sessions": state["sessions"]}
+
+
+def write_checkpoint(output, state):
+    # Replaced whole, so an interrupted write leaves the previous checkpoint
+    tmp_path = f"{checkpoint_path(output)}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, checkpoint_path(output))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export every result of a search, grouped, in constant memory.")
+    parser.add_argument("search", nargs="?", help="JSON file with the search's filters (as for app.batch), "
+                                                  "standard input if omitted")
+    parser.add_argument("--output", required=True, help="File to write")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="ndjson",
+                        help="One activity per line (ndjson) or one session per row (csv)")
+    parser.add_argument("--gzip", action="store_true", help="Gzip the output")
+    parser.add_argument("--resume", action="store_true", help="Continue an interrupted export from its checkpoint")
+    parser.add_argument("--max-pages", type=int, default=EXPORT_MAX_PAGES, help="Last upstream page to fetch")
+    args = parser.parse_args()
+
+    if args.search:
+        with open(args.search) as f:
+            search = json.load(f)
+    else:
+        search = json.load(sys.stdin)
+
+    try:
+        totals = export_to_file(build_search(search), search, args.output, args.format, args.gzip,
+                                args.resume, args.max_pages)
+    except UpstreamUnavailable as e:
+        sys.exit(f"Export stopped: {e}. Run again with --resume to continue from the last checkpoint.")
+    except ValueError as e:
+        sys.exit(f"Export failed: {e}")
+    print(f"{totals['groups']} activities, {totals['sessions']} sessions", file=sys.stderr)
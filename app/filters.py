@@ -0,0 +1,167 @@
+import re
+
+# Upstream's days_of_week bitmask starts on Sunday
+DAY_NAMES = ("Sun", "Mon", "Tue", "Wed", "Thu", "Fri", "Sat")
+WEEKDAYS = frozenset(range(1, 6))
+WEEKEND = frozenset((0, 6))
+EVERY_DAY = frozenset(range(7))
+
+# One and two letter abbreviations, as in "M/W/F" or "Tu,Th". A lone "S" could be either weekend day
+SHORT_DAY_NAMES = {"su": 0, "m": 1, "mo": 1, "t": 2, "tu": 2, "w": 3, "we": 3, "r": 4, "th": 4, "f": 5, "fr": 5,
+                   "sa": 6}
+
+# Words upstream uses for groups of days
+DAY_GROUPS = {"weekdays": WEEKDAYS, "weekday": WEEKDAYS, "weekends": WEEKEND, "weekend": WEEKEND,
+              "daily": EVERY_DAY, "every day": EVERY_DAY, "everyday": EVERY_DAY}
+
+MONTHS_PER_YEAR = 12
+
+_DAY_TOKEN = re.compile(r"(sun|mon|tue|wed|thu|fri|sat)[a-z]*\.?", re.IGNORECASE)
+_AGE_VALUE = re.compile(r"(\d+(?:\.\d+)?)\s*(y(?:ea)?rs?|y|m(?:o(?:nth)?s?)?|)\s*(?:(\d+)\s*m(?:o(?:nth)?s?)?)?", re.IGNORECASE)
+
+
+def day_index(name):
+    """
+    Returns the index (Sunday = 0) of a day name or abbreviation ("Tuesday", "Tue", "Tu", "T"), or None.
+    """
+    name = str(name).strip()
+    short = SHORT_DAY_NAMES.get(name.lower().rstrip("."))
+    if short is not None:
+        return short
+    match = _DAY_TOKEN.fullmatch(name)
+    if match is None:
+        return None
+    return DAY_NAMES.index(match.group(1).capitalize())
+
+
+def normalize_days(days):
+    """
+    Turns day names or indexes (Sunday = 0) into a frozenset of indexes, or None
+    if no day, or every day, was asked for (i.e. no filter).
+    """
+    indexes = set()
+    for day in days or []:
+        if isinstance(day, int) or str(day).isdigit():
+            index = int(day)
+            if 0 <= index < 7:
+                indexes.add(index)
+        else:
+            index = day_index(day)
+            if index is not None:
+                indexes.add(index)
+    if not indexes or indexes == EVERY_DAY:
+        return None
+    return frozenset(indexes)
+
+
+def days_bitmask(days):
+    """
+    Encodes day indexes as upstream's days_of_week string, e.g. {0, 6} -> "1000001".
+    """
+    return "".join("1" if index in days else "0" for index in range(7))
+
+
+def parse_days(text):
+    """
+    Parses upstream's free text days_of_week ("Mon,Wed", "Tue & Thu", "Mon-Fri",
+    "M/W/F", "Tu,Th", "Mon Wed", "Weekends", ...) into day indexes.
+
+    Returns:
+        frozenset: The day indexes, or None if the text could not be read.
+    """
+    text = (text or "").strip().lower()
+    if not text:
+        return None
+    for words, days in DAY_GROUPS.items():
+        if text == words:
+            return days
+
+    days = set()
+    for part in re.split(r"\s*(?:,|/|&|\band\b)\s*", text):
+        if not part:
+            continue
+        if part in DAY_GROUPS:
+            days |= DAY_GROUPS[part]
+            continue
+        bounds = re.split(r"\s*(?:-|\bto\b|\bthru\b|\bthrough\b)\s*", part)
+        if len(bounds) == 2:
+            start, end = day_index(bounds[0]), day_index(bounds[1])
+            if start is None or end is None:
+                return None
+            days.update((start + offset) % 7 for offset in range((end - start) % 7 + 1))
+            continue
+        # Days listed with spaces only, e.g. "Mon Wed"
+        for word in part.split():
+            index = day_index(word)
+            if index is None:
+                # Words we do not know, e.g. a holiday note: safer to keep the activity
+                return None
+            days.add(index)
+    return frozenset(days) or None
+
+
+def _age_in_years(number, unit, months):
+    years = float(number)
+    if unit and unit[0].lower() == "m":
+        return years / MONTHS_PER_YEAR
+    if months:
+        years += int(months) / MONTHS_PER_YEAR
+    return years
+
+
+def parse_age_range(text):
+    """
+    Parses upstream's age_description ("6 - 12 yrs", "18 yrs +", "5y 6m - 8y 11m",
+    "At least 6 but less than 13", "All ages", ...) into years.
+
+    Returns:
+        tuple: (min_age, max_age), either None if open ended, or None if the text could not be read.
+    """
+    text = (text or "").strip().lower()
+    if not text:
+        return None
+    if "all ages" in text:
+        return None, None
+
+    ages = [_age_in_years(*match.groups()) for match in _AGE_VALUE.finditer(text)]
+    # A trailing unit ("6 - 12 yrs") applies to both ends
+    units = [match.group(2) for match in _AGE_VALUE.finditer(text)]
+    if len(ages) == 2 and not units[0] and units[1] and units[1][0].lower() == "m":
+        ages[0] = ages[0] / MONTHS_PER_YEAR
+
+    if len(ages) == 1:
+        if "+" in text or "at least" in text or "and up" in text or "older" in text:
+            return ages[0], None
+        if "under" in text or "less than" in text or "younger" in text:
+            return None, ages[0]
+        return ages[0], ages[0]
+    if len(ages) == 2:
+        return min(ages), max(ages)
+    return None
+
+
+def matches_days(activity, days):
+    """
+    Checks whether activity meets on any of days. Activities whose days cannot be read are kept.
+    """
+    if days is None:
+        return True
+    meets = parse_days(activity.days_of_week)
+    return meets is None or not meets.isdisjoint(days)
+
+
+def matches_ages(activity, min_age=None, max_age=None):
+    """
+    Checks whether activity's age range overlaps [min_age, max_age]. Activities whose ages cannot be read are kept.
+    """
+    if min_age is None and max_age is None:
+        return True
+    ages = parse_age_range(activity.age_description)
+    if ages is None:
+        return True
+    low, high = ages
+    if min_age is not None and high is not None and high < min_age:
+        return False
+    if max_age is not None and low is not None and low > max_age:
+        return False
+    return True
@@ -0,0 +1,144 @@
+import math
+
+from app.database_utils import get_catalog
+from app.db import DB_PATH, read_connection
+from app.metrics import timed
+
+EARTH_RADIUS_MILES = 3958.8
+MILES_PER_DEGREE_LAT = 69.0
+MAX_SEARCH_RADIUS_MILES = 50 # Stop widening k-nearest searches past this radius
+
+
+def haversine_miles(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in miles between two points given in degrees.
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(lat, lon, radius_miles):
+    """
+    Returns the (min_lat, max_lat, min_lon, max_lon) box enclosing a circle around a point.
+    """
+    d_lat = radius_miles / MILES_PER_DEGREE_LAT
+    d_lon = radius_miles / (MILES_PER_DEGREE_LAT * max(math.cos(math.radians(lat)), 1e-6))
+    return lat - d_lat, lat + d_lat, lon - d_lon, lon + d_lon
+
+
+def create_spatial_index(conn):
+    """
+    Builds the parks R*Tree (keyed by parks rowid) and a plain lat/lon index as fallback.
+
+    Args:
+        conn (sqlite3.Connection): Writable connection to the activities database.
+    """
+    with conn:
+        conn.execute("CREATE INDEX IF NOT EXISTS parks_latitude_longitude ON parks(latitude, longitude)")
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS parks_rtree USING rtree(
+                id, min_lat, max_lat, min_lon, max_lon
+            )
+        """)
+        conn.execute("DELETE FROM parks_rtree")
+        conn.execute("""
+            INSERT INTO parks_rtree
+            SELECT rowid, latitude, latitude, longitude, longitude
+            FROM parks
+            WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+        """)
+
+
+def has_spatial_index(conn):
+    """
+    Checks whether the parks R*Tree exists in the connected database.
+    """
+    cur = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'parks_rtree'")
+    return cur.fetchone() is not None
+
+
+def parks_in_box(conn, box):
+    """
+    Fetches (name, city_id, latitude, longitude) for parks inside a bounding box,
+    using the R*Tree when available and the lat/lon columns otherwise.
+    """
+    if has_spatial_index(conn):
+        query = """
+            SELECT p.name, p.city_id, p.latitude, p.longitude
+            FROM parks_rtree r
+            JOIN parks p ON p.rowid = r.id
+            WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lon >= ? AND r.min_lon <= ?
+        """
+    else:
+        query = """
+            SELECT name, city_id, latitude, longitude
+            FROM parks
+            WHERE latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ?
+        """
+    return conn.execute(query, box).fetchall()
+
+
+def nearby_parks(conn, lat, lon, radius_miles=None, limit=None):
+    """
+    Finds parks around a point, nearest first. A bounding box prefilter narrows the
+    candidates before the exact haversine distance is computed.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the activities database.
+        lat (float): Latitude of the search point.
+        lon (float): Longitude of the search point.
+        radius_miles (float): Max distance. If None, the search widens until limit parks are found.
+        limit (int): Max number of parks to return (k nearest).
+
+    Returns:
+        list: Tuples of (park name, city_id, latitude, longitude, distance in miles).
+    """
+    if radius_miles is None:
+        if not limit:
+            raise ValueError("nearby_parks needs a radius, a limit, or both")
+
+        # Widen the box until it holds k parks within the searched radius
+        radius = 1.0
+        while True:
+            results = nearby_parks(conn, lat, lon, radius, limit)
+            if len(results) >= limit or radius >= MAX_SEARCH_RADIUS_MILES:
+                return results
+            radius *= 2
+
+    results = []
+    for name, city_id, park_lat, park_lon in parks_in_box(conn, bounding_box(lat, lon, radius_miles)):
+        distance = haversine_miles(lat, lon, park_lat, park_lon)
+        if distance <= radius_miles:
+            results.append((name, city_id, park_lat, park_lon, distance))
+
+    results.sort(key=lambda park: park[4])
+    return results[:limit] if limit else results
+
+
+@timed("db")
+def parks_within(location, radius_miles, db_path=DB_PATH):
+    """
+    Resolves a (latitude, longitude) location and radius to the parks inside it.
+
+    Returns:
+        list: Tuples of (park name, city_id, latitude, longitude, distance in miles), nearest first.
+    """
+    lat, lon = location
+    return nearby_parks(read_connection(db_path), lat, lon, radius_miles=radius_miles)
+
+
+@timed("db")
+def park_distances(location, names, db_path=DB_PATH):
+    """
+    Maps each named park to its distance in miles from a (latitude, longitude) location.
+    """
+    lat, lon = location
+    park_coordinates = get_catalog(db_path).park_coordinates
+    return {
+        name: haversine_miles(lat, lon, *park_coordinates[name])
+        for name in names
+        if name in park_coordinates
+    }
@@ -0,0 +1,178 @@
+import json
+from bisect import insort
+from datetime import datetime, time
+from functools import lru_cache
+
+from app.records import ActivityGroup
+
+# Positions in a stored session row
+SESSION_COLUMNS = ("sort_date", "sort_time", "date_range", "time_range", "action_link", "detail_link", "days", "id")
+SORT_DATE, SORT_TIME, DATE_RANGE, TIME_RANGE, ACTION_LINK, DETAIL_LINK, DAYS, SESSION_ID = range(len(SESSION_COLUMNS))
+
+
+@lru_cache(maxsize=8192)
+def parse_date_range(date_text):
+    """
+    Parses a session date range such as "June 3, 2025 to Aug 12, 2025".
+    The same strings repeat across thousands of sessions, so results are memoized.
+
+    Returns:
+        tuple: (start date as ISO string for sorting, date range labeled with its weekday)
+    """
+    try:
+        start_date_str = date_text.split(" to ")[0].strip()
+        start_date = datetime.strptime(start_date_str, "%B %d, %Y")
+    except Exception:
+        start_date = datetime(1900, 1, 1)
+
+    weekday = start_date.strftime("%A")
+    if " to " in date_text:
+        # Repeating event
+        date_range = f"{date_text} ({weekday}s)"
+    else:
+        # One off event
+        date_range = f"{date_text} ({weekday})"
+
+    return start_date.date().isoformat(), date_range
+
+
+@lru_cache(maxsize=2048)
+def parse_start_time(time_text):
+    """
+    Parses the start of a session time range such as "9:00 AM - 10:00 AM" or "Noon - 1:00 PM".
+
+    Returns:
+        str: Start time as "HH:MM" for sorting.
+    """
+    try:
+        start_time_str = time_text.split(" - ")[0].strip()
+        if start_time_str.lower() == "noon":
+            start_time = time(12, 0)
+        else:
+            start_time = datetime.strptime(start_time_str, "%I:%M %p").time()
+    except Exception:
+        start_time = time(0, 0)
+
+    return start_time.strftime("%H:%M")
+
+
+def group_key(activity):
+    """
+    Determines uniqueness of an activity using name/location/category/age description.
+    """
+    return json.dumps([
+        activity.name,
+        activity.location,
+        activity.category,
+        activity.age_description
+    ])
+
+
+def session_sort_key(row):
+    return row[:TIME_RANGE + 1]
+
+
+class ActivityGrouper:
+    """
+    Incremental index of grouped activities for one search. Sessions from later
+    batches are merged into the groups they belong to, keeping each group's sessions
+    sorted, so no batch needs regrouping from scratch. The state is plain JSON so it
+    can be kept in the result store between requests.
+    """
+
+    def __init__(self, state=None):
+        state = state or {}
+        self.order = state.get("order", []) # Group keys in display order
+        self.groups = state.get("groups", {}) # Group key -> {"info": {...}, "sessions": [rows]}
+
+    def to_state(self):
+        return {"order": self.order, "groups": self.groups}
+
+    def __len__(self):
+        return len(self.order)
+
+    def add(self, activities, order_key=None):
+        """
+        Merges parsed activities (one per session) into their groups.
+
+        Args:
+            activities (list): Parsed Activity records, as from ActivityScraper.parse_activity.
+            order_key (callable): Optional sort key for placing new groups, given a parsed activity.
+
+        Returns:
+            list: Keys of the groups that were created or changed, in display order.
+        """
+        changed = {}
+        new_groups = []
+        seen_ids = {} # Group key -> session ids already in the group
+
+        for activity in activities:
+            key = group_key(activity)
+            group = self.groups.get(key)
+            if group is None:
+                group = self.groups[key] = {
+                    "info": {
+                        "name": activity.name,
+                        "location": activity.location,
+                        "desc": activity.desc,
+                        "category": activity.category,
+                        "age_description": activity.age_description
+                    },
+                    "sessions": []
+                }
+                new_groups.append((key, activity))
+
+            # Skip sessions already merged from an earlier, overlapping batch
+            session_id = activity.id
+            if session_id is not None:
+                if key not in seen_ids:
+                    seen_ids[key] = {row[SESSION_ID] for row in group["sessions"]}
+                if session_id in seen_ids[key]:
+                    continue
+                seen_ids[key].add(session_id)
+
+            date_text = activity.date_range or ""
+            time_text = activity.time_range or ""
+            sort_date, date_range = parse_date_range(date_text)
+            insort(group["sessions"], [
+                sort_date,
+                parse_start_time(time_text),
+                date_range,
+                time_text,
+                activity.action_link,
+                activity.detail_url,
+                activity.days_of_week or "",
+                session_id
+            ], key=session_sort_key)
+            changed[key] = True
+
+        if order_key is not None:
+            new_groups.sort(key=lambda group: order_key(group[1]))
+        self.order.extend(key for key, _ in new_groups)
+
+        if not changed:
+            return []
+        return [key for key in self.order if key in changed]
+
+    def group(self, key):
+        """
+        Returns one grouped activity with its sessions split into columns.
+
+        Returns:
+            ActivityGroup: The group, sharing no lists with the stored state.
+        """
+        group = self.groups[key]
+        info = group["info"]
+
+        # Transpose the session rows in one pass, giving one tuple per column
+        columns = tuple(zip(*group["sessions"])) or ((),) * len(SESSION_COLUMNS)
+        return ActivityGroup(
+            key, info["name"], info["location"], info["desc"], info["category"], info["age_description"],
+            columns[DATE_RANGE], columns[TIME_RANGE], columns[ACTION_LINK], columns[DETAIL_LINK], columns[DAYS]
+        )
+
+    def grouped(self, keys=None):
+        """
+        Returns grouped activities in display order, all of them or only the given keys.
+        """
+        return [self.group(key) for key in (self.order if keys is None else keys)]
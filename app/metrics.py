@@ -0,0 +1,360 @@
+import contextvars
+import functools
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from app.db import write_connection
+
+# Defaults, overridable through the environment
+METRICS_PATH = os.environ.get("METRICS_PATH", "instance/metrics.db") # Empty keeps metrics per worker
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 5)) # Seconds between writes to METRICS_PATH
+METRICS_STALE_AFTER = float(os.environ.get("METRICS_STALE_AFTER", 300)) # Seconds without a write before a worker's gauges are ignored
+METRICS_RETIRE_AFTER = float(os.environ.get("METRICS_RETIRE_AFTER", 86400)) # Seconds without a write before a worker's rows are folded away
+
+# Process whose row holds the counters of workers gone for good
+RETIRED_PROCESS = "retired"
+
+# Histogram bucket upper bounds, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def format_labels(labels):
+    """
+    Formats labels as a Prometheus label set, e.g. 'phase="upstream"'.
+    """
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return ",".join(f'{key}="{escape(value)}"' for key, value in sorted(labels.items()))
+
+
+class MetricsRegistry:
+    """
+    Counters and histograms for this worker. Each worker periodically writes its
+    running totals to a shared SQLite file under its own id, and /metrics sums the
+    rows of every worker, so any worker can answer for the whole server. Gauges of
+    workers that stopped writing are left out, and after retire_after seconds their
+    counters are folded into one "retired" row, so restarts do not grow the table.
+    """
+
+    def __init__(self, path=METRICS_PATH, flush_interval=METRICS_FLUSH_INTERVAL,
+                 stale_after=METRICS_STALE_AFTER, retire_after=METRICS_RETIRE_AFTER):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.stale_after = stale_after
+        self.retire_after = retire_after
+        self._descriptions = {} # name -> (type, help)
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._reset()
+
+        if self.path:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with self._connect() as conn:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS metrics (
+                        process TEXT NOT NULL,
+                        name TEXT NOT NULL,
+                        labels TEXT NOT NULL,
+                        value REAL NOT NULL,
+                        PRIMARY KEY (process, name, labels)
+                    )
+                """)
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS metric_processes (
+                        process TEXT PRIMARY KEY,
+                        heartbeat REAL NOT NULL
+                    )
+                """)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._process = f"{self._pid}-{uuid.uuid4().hex[:8]}"
+        self._values = {} # (name, labels) -> value
+        self._flushed = None # _values as last written
+        self._baseline = {} # (name, labels) -> part of the value already folded into the retired row
+        self._last_flush = 0.0
+
+    def _check_fork(self):
+        # Workers forked from a master that already counted must not report its totals again
+        if os.getpid() != self._pid:
+            self._reset()
+
+    def _connect(self):
+        return write_connection(self.path, per_thread=True)
+
+    def _gauges(self):
+        return [name for name, (metric_type, _) in self._descriptions.items() if metric_type == "gauge"]
+
+    def describe(self, name, metric_type, help_text):
+        """
+        Declares a metric's type ("counter", "gauge" or "histogram") and help text.
+        """
+        self._descriptions[name] = (metric_type, help_text)
+
+    def add_collector(self, collect):
+        """
+        Registers a callable run before every flush/render, to copy stats kept
+        elsewhere (caches, the prefetcher) into this registry with set().
+        """
+        self._collectors.append(collect)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, format_labels(labels))
+        with self._lock:
+            self._check_fork()
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        """
+        Sets a value this worker tracks cumulatively itself, e.g. a cache's hit count.
+        """
+        with self._lock:
+            self._check_fork()
+            self._values[(name, format_labels(labels))] = value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        """
+        Records one observation in a histogram.
+        """
+        base = format_labels(labels)
+        prefix = f"{base}," if base else ""
+        with self._lock:
+            self._check_fork()
+            values = self._values
+            # le goes last so render() can order buckets by it
+            for bound in buckets:
+                key = (f"{name}_bucket", f'{prefix}le="{bound}"')
+                values[key] = values.get(key, 0) + (value <= bound)
+            for key, amount in (((f"{name}_bucket", f'{prefix}le="+Inf"'), 1),
+                                ((f"{name}_count", base), 1),
+                                ((f"{name}_sum", base), value)):
+                values[key] = values.get(key, 0) + amount
+
+    def _collect(self):
+        for collect in self._collectors:
+            try:
+                collect(self)
+            except Exception:
+                pass
+
+    def flush(self, force=False):
+        """
+        Writes this worker's totals to the shared file, at most once per flush_interval unless forced.
+        """
+        if not self.path:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_flush < self.flush_interval:
+            return
+        self._last_flush = now
+
+        self._collect()
+        with self._lock:
+            self._check_fork()
+            values = dict(self._values)
+        gauges = set(self._gauges())
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            alive = conn.execute("SELECT 1 FROM metric_processes WHERE process = ?", (self._process,)).fetchone()
+            if alive is None and self._flushed is not None:
+                # Retired by another worker while this one sat idle, what it wrote then is in the retired row
+                self._baseline = {key: value for key, value in self._flushed.items() if key[0] not in gauges}
+            conn.executemany("INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?)", [
+                (self._process, name, labels, value - self._baseline.get((name, labels), 0))
+                for (name, labels), value in values.items()
+            ])
+            conn.execute("INSERT OR REPLACE INTO metric_processes VALUES (?, ?)", (self._process, time.time()))
+            self._retire(conn, gauges)
+            conn.execute("COMMIT")
+            self._flushed = values
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _retire(self, conn, gauges):
+        """
+        Folds the counters of workers that have not written for retire_after seconds
+        into the retired row and drops their rows. Runs inside flush's transaction.
+        """
+        cutoff = time.time() - self.retire_after
+        # Processes without a heartbeat were written before heartbeats existed
+        processes = [row[0] for row in conn.execute("""
+            SELECT DISTINCT m.process FROM metrics m LEFT JOIN metric_processes p USING (process)
+            WHERE m.process != ? AND (p.heartbeat IS NULL OR p.heartbeat < ?)
+        """, (RETIRED_PROCESS, cutoff))]
+        processes += [row[0] for row in conn.execute(
+            "SELECT process FROM metric_processes WHERE heartbeat < ?", (cutoff,)) if row[0] not in processes]
+
+        placeholders = ",".join("?" * len(gauges))
+        for process in processes:
+            conn.execute(f"""
+                INSERT INTO metrics (process, name, labels, value)
+                SELECT ?, name, labels, value FROM metrics WHERE process = ? AND name NOT IN ({placeholders})
+                ON CONFLICT (process, name, labels) DO UPDATE SET value = value + excluded.value
+            """, (RETIRED_PROCESS, process, *gauges))
+            conn.execute("DELETE FROM metrics WHERE process = ?", (process,))
+            conn.execute("DELETE FROM metric_processes WHERE process = ?", (process,))
+
+    def totals(self):
+        """
+        Returns {(name, labels): value} summed over every worker.
+        """
+        if not self.path:
+            self._collect()
+            with self._lock:
+                self._check_fork()
+                return dict(self._values)
+
+        self.flush(force=True)
+        gauges = self._gauges()
+        placeholders = ",".join("?" * len(gauges))
+        # Gauges describe the present, so only count workers still writing
+        rows = self._connect().execute(f"""
+            SELECT name, labels, SUM(value) FROM metrics LEFT JOIN metric_processes USING (process)
+            WHERE name NOT IN ({placeholders}) OR heartbeat >= ?
+            GROUP BY name, labels
+        """, (*gauges, time.time() - self.stale_after))
+        return {(name, labels): value for name, labels, value in rows}
+
+    def render(self):
+        """
+        Renders all metrics in the Prometheus text exposition format.
+        """
+        by_family = {}
+        for (name, labels), value in self.totals().items():
+            family = name
+            for suffix in ("_bucket", "_count", "_sum"):
+                if name.endswith(suffix) and name[:-len(suffix)] in self._descriptions:
+                    family = name[:-len(suffix)]
+            by_family.setdefault(family, []).append((name, labels, value))
+
+        def bucket_order(sample):
+            # Keep histogram buckets in ascending le order
+            name, labels, _ = sample
+            if not name.endswith("_bucket"):
+                return name, labels, 0.0
+            base, le = labels.rsplit('le="', 1)
+            return name, base, float(le.rstrip('"'))
+
+        lines = []
+        for family in sorted(by_family):
+            metric_type, help_text = self._descriptions.get(family, ("untyped", ""))
+            lines.append(f"# HELP {family} {help_text}")
+            lines.append(f"# TYPE {family} {metric_type}")
+            for name, labels, value in sorted(by_family[family], key=bucket_order):
+                value = int(value) if float(value).is_integer() else value
+                lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class RequestMetrics:
+    """
+    Time spent per phase and upstream traffic of one request, for its Server-Timing header.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {} # phase -> [seconds, count]
+        self.upstream_pages = 0
+        self.upstream_bytes = 0
+
+    def add(self, phase, seconds):
+        entry = self.phases.setdefault(phase, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += 1
+
+    def server_timing(self):
+        """
+        Builds the Server-Timing header value. Phases that run concurrently (upstream
+        pages) are summed, so they can add up to more than the total.
+        """
+        parts = []
+        for phase, (seconds, count) in self.phases.items():
+            description = f"{count}x"
+            if phase == "upstream":
+                description = f"{self.upstream_pages} pages, {self.upstream_bytes} bytes"
+            parts.append(f'{phase};dur={seconds * 1000:.1f};desc="{description}"')
+        parts.append(f"total;dur={(time.perf_counter() - self.start) * 1000:.1f}")
+        return ", ".join(parts)
+
+
+registry = MetricsRegistry()
+registry.describe("http_request_duration_seconds", "histogram", "Time to produce a response (to first byte for streams).")
+registry.describe("phase_duration_seconds", "histogram", "Time spent in each phase of handling a search.")
+registry.describe("upstream_pages_total", "counter", "Pages fetched from the activities API.")
+registry.describe("upstream_bytes_total", "counter", "Bytes received from the activities API.")
+registry.describe("upstream_retries_total", "counter", "Upstream requests retried, by reason.")
+registry.describe("upstream_failures_total", "counter", "Upstream pages given up on, by reason.")
+registry.describe("upstream_circuit_opened_total", "counter", "Times repeated upstream failures opened the circuit.")
+registry.describe("upstream_stale_pages_total", "counter", "Expired cached pages served because upstream was unavailable.")
+registry.describe("single_flight_shared_total", "counter",
+                  "Page fetches that waited on an identical one in flight, in this worker or another.")
+registry.describe("page_cache_hits_total", "counter", "Upstream pages served from the page cache.")
+registry.describe("page_cache_misses_total", "counter", "Upstream pages not found in the page cache.")
+registry.describe("prefetch_scheduled_total", "counter", "load_more batches prefetched.")
+registry.describe("prefetch_hits_total", "counter", "load_more requests answered from a prefetch.")
+registry.describe("prefetch_misses_total", "counter", "load_more requests that had to fetch themselves.")
+registry.describe("prefetch_wasted_total", "counter", "Prefetched batches that were never used.")
+registry.describe("prefetch_pending", "gauge", "Prefetched batches waiting to be claimed.")
+registry.describe("export_incomplete_total", "counter", "Exports cut short because upstream failed partway.")
+
+# The request being handled in this context. asyncio tasks inherit it, threads do not
+_current_request = contextvars.ContextVar("current_request", default=None)
+
+
+def start_request():
+    """
+    Starts collecting phase timings for the request handled in this context.
+    """
+    request_metrics = RequestMetrics()
+    _current_request.set(request_metrics)
+    return request_metrics
+
+
+def current_request():
+    return _current_request.get()
+
+
+@contextmanager
+def span(phase):
+    """
+    Times a block as one occurrence of phase, for /metrics and the current request.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        registry.observe("phase_duration_seconds", seconds, phase=phase)
+        request_metrics = _current_request.get()
+        if request_metrics is not None:
+            request_metrics.add(phase, seconds)
+
+
+def timed(phase):
+    """
+    Decorator timing every call of a function as phase.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(phase):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_upstream(pages, nbytes):
+    """
+    Counts pages and bytes received from upstream.
+    """
+    registry.inc("upstream_pages_total", pages)
+    registry.inc("upstream_bytes_total", nbytes)
+    request_metrics = _current_request.get()
+    if request_metrics is not None:
+        request_metrics.upstream_pages += pages
+        request_metrics.upstream_bytes += nbytes
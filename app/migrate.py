@@ -0,0 +1,64 @@
+import argparse
+
+from app.db import DB_PATH, write_connection
+from app.geo import create_spatial_index
+
+# Applied in order, once each. PRAGMA user_version records how many have run.
+MIGRATIONS = [
+    # Name lookups from the search form
+    """
+    CREATE INDEX IF NOT EXISTS parks_name ON parks(name);
+    CREATE INDEX IF NOT EXISTS activities_name ON activities(name);
+    CREATE INDEX IF NOT EXISTS activities_type_name ON activities(type, name);
+    """,
+    # Parks R*Tree for nearby searches
+    create_spatial_index,
+    # Form lists, sorted once here instead of by every worker
+    """
+    CREATE TABLE IF NOT EXISTS reference_lists (
+        kind TEXT NOT NULL,
+        name TEXT NOT NULL,
+        city_id INTEGER NOT NULL,
+        PRIMARY KEY (kind, name)
+    ) WITHOUT ROWID;
+    DELETE FROM reference_lists;
+    INSERT OR IGNORE INTO reference_lists
+    SELECT CASE type WHEN 'ActivityOtherCategoryID' THEN 'category' ELSE 'age_group' END, name, city_id
+    FROM activities
+    WHERE type IN ('ActivityOtherCategoryID', 'ActivityCategoryID');
+    """,
+]
+
+
+def migrate(db_path=DB_PATH):
+    """
+    Applies any migrations the database has not seen yet.
+
+    Args:
+        db_path (str): Path to the activities database.
+
+    Returns:
+        int: Number of migrations applied.
+    """
+    conn = write_connection(db_path)
+    try:
+        (version,) = conn.execute("PRAGMA user_version").fetchone()
+        for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+            if callable(step):
+                step(conn)
+            else:
+                conn.executescript(step)
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        return max(len(MIGRATIONS) - version, 0)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create missing indexes in the activities database.")
+    parser.add_argument("--db", default=DB_PATH, help="Path to the activities database")
+    args = parser.parse_args()
+
+    applied = migrate(args.db)
+    print(f"Applied {applied} migration(s) to {args.db}")
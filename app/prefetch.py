@@ -0,0 +1,159 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+PREFETCH_WORKERS = int(os.environ.get("PREFETCH_WORKERS", 4)) # Batches prefetched at once per worker
+PREFETCH_TTL = int(os.environ.get("PREFETCH_TTL", 300)) # Seconds a prefetched batch waits to be claimed
+PREFETCH_MAX_PENDING = int(os.environ.get("PREFETCH_MAX_PENDING", 100)) # Prefetches held per worker
+PREFETCH_WAIT = 10 # Seconds load_more waits on a prefetch that is still running
+
+
+class Prefetcher:
+    """
+    Fetches the next load_more batch of a search in the background, so clicking
+    "load more" can be answered without waiting on upstream. Each search (owner) has
+    at most one pending prefetch; scheduling a new one or cancelling the owner
+    discards it, and prefetches unclaimed after ttl seconds, or beyond max_pending,
+    are dropped. With a store, finished batches are also kept there, so a load_more
+    answered by another worker can claim them.
+    """
+
+    def __init__(self, max_workers=PREFETCH_WORKERS, store=None, ttl=PREFETCH_TTL, max_pending=PREFETCH_MAX_PENDING):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self.store = store # ResultStore shared by the workers, or None
+        self.ttl = ttl
+        self.max_pending = max_pending
+        self._pending = {} # owner -> (first_page, future, scheduled_at), oldest first
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.scheduled = 0
+        self.hits = 0 # load_more served from a prefetch
+        self.misses = 0 # load_more had to scrape itself
+        self.wasted = 0 # prefetches fetched but never used
+
+    def _fetch(self, owner, scraper):
+        scraper.get_activities()
+        if self.store is not None:
+            self.store.save_batch(owner, scraper, ttl=self.ttl)
+        return scraper
+
+    def _expired(self, now):
+        """
+        Pops the prefetches past their ttl, then the oldest beyond max_pending. Call with the lock held.
+        """
+        expired = [owner for owner, (_, _, scheduled_at) in self._pending.items() if scheduled_at + self.ttl < now]
+        excess = len(self._pending) - len(expired) - self.max_pending
+        if excess > 0:
+            expired += [owner for owner in self._pending if owner not in expired][:excess]
+        return [(owner, self._pending.pop(owner)) for owner in expired]
+
+    def _discard(self, owner, entry):
+        """
+        Cancels a pending prefetch, counting it as wasted if it already ran and was
+        not claimed through the store by another worker.
+        """
+        first_page, future, _ = entry
+        if future.cancel():
+            return
+        if self.store is not None:
+            if self.store.batch_claimed(owner, first_page):
+                return
+            self.store.drop_batch(owner, first_page)
+        with self._lock:
+            self.wasted += 1
+
+    def schedule(self, owner, scraper):
+        """
+        Starts fetching scraper's batch in the background for owner, replacing any
+        earlier prefetch of the same owner.
+
+        Args:
+            owner (str): Search id the batch belongs to.
+            scraper (ActivityScraper): Scraper set up for the batch to fetch.
+        """
+        with self._lock:
+            discarded = self._expired(time.time())
+            previous = self._pending.pop(owner, None)
+            if previous is not None:
+                discarded.append((owner, previous))
+        # Before starting the new batch, whose stored copy would replace the old one's
+        for entry in discarded:
+            self._discard(*entry)
+
+        future = self.executor.submit(self._fetch, owner, scraper)
+        with self._lock:
+            self._pending[owner] = (scraper.first_page, future, time.time())
+            self.scheduled += 1
+
+    def claim(self, owner, first_page, make_scraper=None, timeout=PREFETCH_WAIT):
+        """
+        Takes owner's prefetched batch if it starts at first_page, waiting for it if
+        still running here, or from the store if another worker prefetched it.
+
+        Args:
+            owner (str): Search id the batch belongs to.
+            first_page (int): First page of the batch load_more wants.
+            make_scraper (callable): Returns a scraper for the batch, set up as it was prefetched,
+                                     to fill with a batch from the store.
+            timeout (float): Seconds to wait on a prefetch still running.
+
+        Returns:
+            ActivityScraper: The scraper with activities fetched, or None on a miss.
+        """
+        with self._lock:
+            entry = self._pending.pop(owner, None)
+        if entry is not None and entry[0] != first_page:
+            self._discard(owner, entry)
+            entry = None
+
+        scraper = None
+        if entry is not None:
+            try:
+                scraper = entry[1].result(timeout=timeout)
+            except Exception:
+                # Cancelled, failed or still running after timeout
+                scraper = None
+            if scraper is not None and self.store is not None:
+                self.store.drop_batch(owner, first_page)
+        elif self.store is not None and make_scraper is not None:
+            scraper = make_scraper()
+            if not self.store.take_batch(owner, first_page, scraper):
+                scraper = None
+
+        with self._lock:
+            if scraper is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return scraper
+
+    def cancel(self, owner):
+        """
+        Drops owner's pending prefetch, e.g. when the user starts a new search.
+        """
+        with self._lock:
+            entry = self._pending.pop(owner, None)
+        if entry is not None:
+            self._discard(owner, entry)
+
+    def stats(self):
+        """
+        Returns prefetch counters and the hit rate of load_more requests.
+        """
+        with self._lock:
+            discarded = self._expired(time.time())
+        for entry in discarded:
+            self._discard(*entry)
+
+        with self._lock:
+            claimed = self.hits + self.misses
+            return {
+                "scheduled": self.scheduled,
+                "pending": len(self._pending),
+                "hits": self.hits,
+                "misses": self.misses,
+                "wasted": self.wasted,
+                "hit_rate": self.hits / claimed if claimed else 0.0
+            }
@@ -0,0 +1,119 @@
+import json
+
+# Fields of a parsed upstream session, in storage order
+ACTIVITY_FIELDS = (
+    "id", "name", "desc", "age_description", "category", "date_range",
+    "time_range", "location", "detail_url", "action_link", "days_of_week", "open_spots"
+)
+
+# Fields of a grouped activity, the per-session fields are parallel columns
+GROUP_FIELDS = (
+    "key", "name", "location", "desc", "category", "age_description",
+    "date_ranges", "time_ranges", "action_links", "detail_links", "days"
+)
+
+
+class Activity:
+    """
+    One parsed upstream session. The upstream API returns one record per session,
+    so searches hold hundreds of these; __slots__ keeps each one a fraction of the
+    size of the equivalent dict.
+    """
+    __slots__ = ACTIVITY_FIELDS
+
+    def __init__(self, id=None, name=None, desc=None, age_description=None, category=None,
+                 date_range=None, time_range=None, location=None, detail_url=None,
+                 action_link=None, days_of_week="", open_spots=None):
+        self.id = id
+        self.name = name
+        self.desc = desc
+        self.age_description = age_description
+        self.category = category
+        self.date_range = date_range
+        self.time_range = time_range
+        self.location = location
+        self.detail_url = detail_url
+        self.action_link = action_link
+        self.days_of_week = days_of_week
+        self.open_spots = open_spots
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        Builds an activity from a tuple in ACTIVITY_FIELDS order, e.g. a database row.
+        """
+        return cls(*row)
+
+    def to_row(self):
+        """
+        Returns the activity as a tuple in ACTIVITY_FIELDS order.
+        """
+        return (
+            self.id, self.name, self.desc, self.age_description, self.category, self.date_range,
+            self.time_range, self.location, self.detail_url, self.action_link, self.days_of_week,
+            self.open_spots
+        )
+
+    def to_dict(self):
+        return dict(zip(ACTIVITY_FIELDS, self.to_row()))
+
+    def __repr__(self):
+        return f"Activity(id={self.id!r}, name={self.name!r}, location={self.location!r})"
+
+
+class ActivityGroup:
+    """
+    One activity with all of its sessions, as shown on a results card. Sessions are
+    held column by column (date_ranges[i], time_ranges[i], ... describe session i),
+    which is the shape both the results template and results.js read.
+    """
+    __slots__ = GROUP_FIELDS
+
+    def __init__(self, key, name, location, desc, category, age_description,
+                 date_ranges=(), time_ranges=(), action_links=(), detail_links=(), days=()):
+        self.key = key
+        self.name = name
+        self.location = location
+        self.desc = desc
+        self.category = category
+        self.age_description = age_description
+        self.date_ranges = date_ranges
+        self.time_ranges = time_ranges
+        self.action_links = action_links
+        self.detail_links = detail_links
+        self.days = days
+
+    def to_dict(self):
+        return {
+            "key": self.key,
+            "name": self.name,
+            "location": self.location,
+            "desc": self.desc,
+            "category": self.category,
+            "age_description": self.age_description,
+            "date_ranges": self.date_ranges,
+            "time_ranges": self.time_ranges,
+            "action_links": self.action_links,
+            "detail_links": self.detail_links,
+            "days": self.days
+        }
+
+    def __repr__(self):
+        return f"ActivityGroup(name={self.name!r}, location={self.location!r}, sessions={len(self.date_ranges)})"
+
+
+def encode_record(value):
+    """
+    json.dumps hook turning records into plain dicts.
+    """
+    if isinstance(value, (Activity, ActivityGroup)):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def to_json(value):
+    """
+    Serializes a response payload that may contain records. Compact output, no key
+    sorting and no circular reference checks, since payloads are plain trees.
+    """
+    return json.dumps(value, default=encode_record, separators=(",", ":"), check_circular=False)
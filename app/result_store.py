@@ -0,0 +1,168 @@
+import json
+import os
+import uuid
+import zlib
+
+from app.cache import SQLiteTTLCache, TTLCache
+from app.grouping import ActivityGrouper
+from app.metrics import timed
+from app.records import Activity
+
+# Defaults, overridable through the environment
+RESULT_STORE_TTL = int(os.environ.get("RESULT_STORE_TTL", 3600)) # Seconds a search's results are kept
+RESULT_STORE_SIZE = int(os.environ.get("RESULT_STORE_SIZE", 1000)) # Max number of searches kept
+RESULT_STORE_PATH = os.environ.get("RESULT_STORE_PATH", "instance/results.db") # Empty keeps results in-process
+
+
+def dumps(value):
+    """
+    Serializes a value as compact, zlib-compressed JSON.
+    """
+    return zlib.compress(json.dumps(value, separators=(",", ":")).encode("utf-8"))
+
+
+def loads(blob):
+    """
+    Reverses dumps.
+    """
+    return json.loads(zlib.decompress(blob))
+
+
+class ResultStore:
+    """
+    Keeps each search's grouped activities server-side under a random search id,
+    so the Flask session only needs to hold that id.
+    """
+
+    def __init__(self, path=RESULT_STORE_PATH, ttl=RESULT_STORE_TTL, max_entries=RESULT_STORE_SIZE):
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.cache = SQLiteTTLCache(path, ttl=ttl, max_entries=max_entries, table="results",
+                                        dumps=dumps, loads=loads)
+        else:
+            self.cache = TTLCache(ttl=ttl, max_entries=max_entries)
+
+    def new_search(self, grouper=None, more_results_to_fetch=False, complete=True, next_page=None):
+        """
+        Stores the first batch of a new search. A search created with complete=False
+        is still being fetched (e.g. streamed) and is filled in later with save().
+
+        Returns:
+            str: The search id to keep in the session.
+        """
+        search_id = uuid.uuid4().hex
+        self.save(search_id, grouper or ActivityGrouper(), more_results_to_fetch, complete, next_page)
+        return search_id
+
+    @timed("result_store")
+    def save(self, search_id, grouper, more_results_to_fetch=False, complete=True, next_page=None):
+        """
+        Replaces a search's grouped activities and status, refreshing its expiry.
+        next_page is the first page not fetched yet, where load more picks up.
+        """
+        self.cache.set(search_id, {
+            "grouping": grouper.to_state(),
+            "more_results_to_fetch": more_results_to_fetch,
+            "complete": complete,
+            "next_page": next_page
+        })
+
+    def _entry(self, search_id):
+        if not search_id:
+            return None
+        return self.cache.get(search_id)
+
+    @timed("result_store")
+    def grouper(self, search_id):
+        """
+        Returns the search's grouping index, to merge later batches into.
+        """
+        entry = self._entry(search_id)
+        return ActivityGrouper(entry["grouping"] if entry else None)
+
+    def get(self, search_id):
+        """
+        Returns all grouped activities for a search, or an empty list if unknown or expired.
+        """
+        return self.grouper(search_id).grouped()
+
+    def status(self, search_id):
+        """
+        Returns (complete, more_results_to_fetch) for a search. Unknown searches count as complete.
+        """
+        entry = self._entry(search_id)
+        if not entry:
+            return True, False
+        return entry["complete"], entry["more_results_to_fetch"]
+
+    def next_page(self, search_id):
+        """
+        Returns the page load more continues the search from, or None if unknown or nothing is left.
+        """
+        entry = self._entry(search_id)
+        return entry.get("next_page") if entry else None
+
+    def page(self, search_id, offset=0, limit=50):
+        """
+        Returns a slice of a search's grouped activities and the total count.
+        """
+        grouper = self.grouper(search_id)
+        return grouper.grouped(grouper.order[offset:offset + limit]), len(grouper)
+
+    def _batch_key(self, search_id):
+        return f"{search_id}:prefetch"
+
+    @timed("result_store")
+    def save_batch(self, search_id, scraper, ttl=None):
+        """
+        Keeps a prefetched, ungrouped batch of a search, so whichever worker answers
+        the next load_more can use it. A search has at most one batch waiting.
+
+        Args:
+            search_id (str): The search the batch belongs to.
+            scraper (ActivityScraper): Scraper with the batch fetched.
+            ttl (int): Seconds to keep the batch, the store's TTL if None.
+        """
+        self.cache.set(self._batch_key(search_id), {
+            "first_page": scraper.first_page,
+            "rows": [activity.to_row() for activity in scraper.activities],
+            "more_results_to_fetch": scraper.more_results_to_fetch,
+            "next_page": scraper.next_page,
+            "degraded": scraper.degraded
+        }, ttl=ttl)
+
+    def batch_claimed(self, search_id, first_page):
+        """
+        Returns whether the search's batch starting at first_page was taken by a load_more.
+        """
+        entry = self.cache.get(self._batch_key(search_id))
+        return entry is not None and entry["first_page"] == first_page and entry.get("claimed", False)
+
+    @timed("result_store")
+    def take_batch(self, search_id, first_page, scraper):
+        """
+        Moves a search's prefetched batch into scraper if it starts at first_page.
+        Only a marker is left behind, so the worker that prefetched it can tell it was used.
+
+        Returns:
+            bool: Whether there was such a batch.
+        """
+        key = self._batch_key(search_id)
+        entry = self.cache.get(key)
+        if entry is None or entry["first_page"] != first_page or entry.get("claimed"):
+            return False
+        self.cache.set(key, {"first_page": first_page, "claimed": True})
+        scraper.activities = [Activity.from_row(row) for row in entry["rows"]]
+        scraper.more_results_to_fetch = entry["more_results_to_fetch"]
+        scraper.next_page = entry.get("next_page")
+        scraper.degraded = entry["degraded"]
+        return True
+
+    def drop_batch(self, search_id, first_page):
+        """
+        Removes the search's prefetched batch if it starts at first_page.
+        """
+        key = self._batch_key(search_id)
+        entry = self.cache.get(key)
+        if entry is not None and entry["first_page"] == first_page:
+            self.cache.delete(key)
@@ -1,12 +1,23 @@
+import asyncio
 import httpx
 import json
-from time import sleep
-from datetime import datetime, time 
+import math
+import os
+from contextlib import asynccontextmanager
 
+from app.aio import background, run_blocking
+from app.cache import build_page_cache
 from app.database_utils import (
     db_names_to_ids,
     clean_park_facility_name
 )
+from app.filters import days_bitmask, matches_ages, matches_days, normalize_days
+from app.geo import parks_within, park_distances
+from app.grouping import ActivityGrouper
+from app.metrics import count_upstream, registry as metrics, span
+from app.records import Activity, encode_record
+from app.singleflight import SingleFlight
+from app.upstream import UpstreamUnavailable, build_upstream
 
 class ActivityScraper:
     """
@@ -15,27 +26,49 @@ class ActivityScraper:
     """
     MAX_PAGES_PER_SCRAPE = 5 # Show 5 pages of results at a time 
     RECORDS_PER_PAGE = 20 # Each page has 20 results
+    MAX_CONCURRENT_REQUESTS = 5 # Upper bound on pages requested from upstream at once
+    REQUEST_TIMEOUT = 15 # Seconds to wait on a single upstream page
+    KM_PER_MILE = 1.609344
+
+    # Upstream search endpoint, overridable to point at a local stand-in (see bench/fake_api.py)
+    API_URL = os.environ.get(
+        "ACTIVITIES_API_URL",
+        "https://anc.apm.activecommunities.com/chicagoparkdistrict/rest/activities/list?locale=en-US"
+    )
+
+    # Upstream pages shared by every scraper in this worker (or across workers, see app.cache)
+    page_cache = build_page_cache()
+
+    # Rate limit, retries and circuit breaker for every upstream request (see app.upstream)
+    upstream = build_upstream()
+
+    # Identical page requests in flight at once are fetched once and shared (see app.singleflight)
+    in_flight = SingleFlight()
 
     def __init__(self, 
-                 distance_miles=None, # Not using at the moment
-                 distance_km=None, # Not using at the moment
+                 distance_miles=None, # Radius around location, used when no parks are given
+                 distance_km=None, # Same as distance_miles, in kilometers
                  parks=[], # List of desired parks/facilities
-                 location=(41.7943, -87.5907), # Default to downtown
+                 location=(41.7943, -87.5907), # Default to downtown, used for radius search and ordering
                  categories=[], # List of desired activity categories
                  age_groups=[], # List of desired activity age groups
                  open_slots=1, # How many slots needed for activity
-                 min_age=None, # Not using at the moment
-                 max_age=None, # Not using at the moment
-                 days_of_week=None, # Not using at the moment
+                 min_age=None, # Youngest age (years) the activity should allow
+                 max_age=None, # Oldest age (years) the activity should allow
+                 days_of_week=None, # Day names or indexes (Sunday = 0) the activity should meet on
                  order_by="Name", # Not using at the moment
-                 first_page=1 # First page to start scraping
+                 first_page=1, # First page to start scraping
+                 max_concurrency=None, # Pages fetched in parallel, defaults to MAX_CONCURRENT_REQUESTS
+                 use_cache=True # Serve repeated pages from page_cache
                  ): 
 
         # Default search parameters
         self.location = location
         self.first_page = first_page
+        self.max_concurrency = max_concurrency or self.MAX_CONCURRENT_REQUESTS
+        self.use_cache = use_cache
         self.order_by = order_by
-        self.base_url = "https://anc.apm.activecommunities.com/chicagoparkdistrict/rest/activities/list?locale=en-US"
+        self.base_url = self.API_URL
         self.headers = {
             "Content-Type": "application/json;charset=utf-8",
             "X-Requested-With": "XMLHttpRequest",
@@ -44,6 +77,12 @@ class ActivityScraper:
         # Binary flag - set to true if last page of searches reached and still have more results
         self.more_results_to_fetch = False
 
+        # First page not fetched yet, where load more picks up when more_results_to_fetch is set
+        self.next_page = None
+
+        # Set if upstream was unavailable and results came from stale cached pages or were cut short
+        self.degraded = False
+
         # If specific categories/age groups passed in, convert their names to IDs
         self.categories = db_names_to_ids(categories, "activities") if categories else []
         self.age_groups = db_names_to_ids(age_groups, "activities") if age_groups else []
@@ -51,17 +90,46 @@ class ActivityScraper:
         # Open slots preset to 1
         self.open_slots = open_slots
         
-        # Other search queries - unused for now 
+        # Narrowing filters, sent upstream and applied again to what comes back
         self.min_age = min_age
         self.max_age = max_age
-        self.days_of_week = days_of_week
-
-        # Convert list of park names to IDs
-        self.parks = db_names_to_ids(parks, "parks")
+        self.days_of_week = normalize_days(days_of_week)
+
+        # Pages upstream reports for this search, once a page has been fetched from it
+        self.total_pages = None
+
+        # Search radius in miles, if any
+        if distance_miles is None and distance_km is not None:
+            distance_miles = distance_km / self.KM_PER_MILE
+        self.distance_miles = distance_miles
+
+        # Park name -> miles from location, used to order results
+        self.park_distances = {}
+
+        # Set if a radius search matched no parks, so there is nothing to fetch
+        self.no_matching_parks = False
+
+        if parks:
+            # Convert list of park names to IDs
+            self.parks = db_names_to_ids(parks, "parks")
+        elif self.has_location() and self.distance_miles:
+            # Resolve the radius to the parks inside it, nearest first
+            nearby = parks_within(self.location, self.distance_miles)
+            self.parks = [city_id for _, city_id, _, _, _ in nearby]
+            self.park_distances = {name: distance for name, _, _, _, distance in nearby}
+            self.no_matching_parks = not self.parks
+        else:
+            self.parks = []
 
         # To fill with self.get_activities()
         self.activities = []
 
+    def has_location(self):
+        """
+        Checks whether a full (latitude, longitude) location was given.
+        """
+        return bool(self.location) and None not in self.location
+
     def build_headers(self, page_num):
         """
         Takes in page number and builds headers for scraper
@@ -74,114 +142,34 @@ class ActivityScraper:
         })
         return headers
 
-    def initialize_group(self, activity):
+    def cache_key(self, headers):
         """
-        Initializes a group structure to aggregate multiple sessions of the same activity.
+        Builds the page cache key from the normalized payload and the page_info header.
         """
-        return {
-            "name": activity["name"],
-            "location": activity["location"],
-            "desc": activity["desc"],
-            "category": activity["category"],
-            "age_description": activity["age_description"],
-            "sessions": []
+        pattern = {
+            key: sorted(value) if isinstance(value, list) else value
+            for key, value in self.payload["activity_search_pattern"].items()
         }
-
-    def start_date_time(self, date_text, time_text):
-        """
-        Parses session start date and time from text formats.
-        """
-        try:
-            start_date_str = date_text.split(" to ")[0].strip()
-            start_date = datetime.strptime(start_date_str, "%B %d, %Y")
-        except Exception:
-            start_date = datetime(1900, 1, 1)
-
-        try:
-            start_time_str = time_text.split(" - ")[0].strip()
-            if start_time_str.lower() == "noon":
-                start_time = time(12, 0)
-            else:
-                start_time = datetime.strptime(start_time_str, "%I:%M %p").time()
-        except Exception:
-            start_time = time(0, 0)
-
-        return start_date, start_time
-
-    def build_sorted_sessions_list(self, session_list):
-        """
-        Sorts a list of session dictionaries by start date and time.
-        """
-        sessions = []
-
-        for session in session_list:
-            start_date, start_time = self.start_date_time(session["date_range"], session["time_range"])
-            weekday = start_date.strftime("%A")
-            
-            if " to " in session["date_range"]:
-                # Repeating event 
-                date_range = f"{session['date_range']} ({weekday}s)"
-            else:
-                # One off event
-                date_range = f"{session['date_range']} ({weekday})"
-
-            # Append information to include in sorted session table on results page
-            sessions.append((
-                
-                # Start_date and time only used for sorting (not kept)
-                start_date,
-                start_time,
-                
-                # Returned per activity after sorting
-                date_range,
-                session["time_range"],
-                session["action_link"],
-                session["detail_link"],
-                session["days"]
-            ))
-            
-        # Sort and return date_range, time_range, action link, detail_link, days
-        sessions.sort()
-        return [session[2:] for session in sessions]
-
-    def unpack_sessions(self, sorted_sessions):
-        """
-        Unpacks a sorted session list into individual session attributes.
-        """
-        date_ranges = []
-        time_ranges = []
-        action_links = []
-        detail_links = []
-        days = []
-
-        for sorted_session in sorted_sessions:
-            date_range, time_range, action_link, detail_link, day = sorted_session
-            
-            date_ranges.append(date_range)
-            time_ranges.append(time_range)
-            action_links.append(action_link)
-            detail_links.append(detail_link)
-            days.append(day)
-
-        return date_ranges, time_ranges, action_links, detail_links, days
+        return json.dumps([pattern, headers["page_info"]], sort_keys=True, separators=(",", ":"))
 
     def parse_activity(self, activity_data):
         """
-        Parses an activity JSON object into a clean dictionary format.
-        """
-        return {
-            "id": activity_data.get("id"),
-            "name": activity_data.get("name"),
-            "desc": activity_data.get("desc"),
-            "age_description": activity_data.get("age_description"),
-            "category": activity_data.get("category"),
-            "date_range": activity_data.get("date_range"),
-            "time_range": activity_data.get("time_range"),
-            "location": clean_park_facility_name(activity_data.get("location", {}).get("label")),
-            "detail_url": activity_data.get("detail_url"),
-            "action_link": activity_data.get("action_link", {}).get("href") if activity_data.get("action_link") else None,
-            "days_of_week": activity_data.get("days_of_week", "")
-        }
+        Parses an activity JSON object into a compact Activity record.
+        """
+        return Activity(
+            id=activity_data.get("id"),
+            name=activity_data.get("name"),
+            desc=activity_data.get("desc"),
+            age_description=activity_data.get("age_description"),
+            category=activity_data.get("category"),
+            date_range=activity_data.get("date_range"),
+            time_range=activity_data.get("time_range"),
+            location=clean_park_facility_name(activity_data.get("location", {}).get("label")),
+            detail_url=activity_data.get("detail_url"),
+            action_link=activity_data.get("action_link", {}).get("href") if activity_data.get("action_link") else None,
+            days_of_week=activity_data.get("days_of_week", ""),
+            open_spots=activity_data.get("total_open")
+        )
 
     def set_payload(self):
         """
@@ -195,96 +183,269 @@ class ActivityScraper:
                 "activity_category_ids": self.age_groups,
                 "activity_other_category_ids": self.categories,
                 # "activity_id": None, # Not currently using in our query format
-                # "days_of_week": self.days_of_week, - Not currently used
-                # "min_age": self.min_age, - Not currently used
-                # "max_age": self.max_age, - Not currently used
             },
             "activity_transfer_pattern": {}
         }
 
-    def build_session(self, activity):
+        # Only sent when set, so unfiltered searches keep sharing cached pages
+        pattern = self.payload["activity_search_pattern"]
+        if self.days_of_week is not None:
+            pattern["days_of_week"] = days_bitmask(self.days_of_week)
+        if self.min_age is not None:
+            pattern["min_age"] = self.min_age
+        if self.max_age is not None:
+            pattern["max_age"] = self.max_age
+
+    def is_narrowed(self):
         """
-        Builds a single session dictionary from a parsed activity.
+        Checks whether days or ages narrow the search, so results usually fit on a page or two.
         """
-        return {
-            "date_range": activity.get("date_range", ""),
-            "time_range": activity.get("time_range", ""),
-            "action_link": activity.get("action_link"),
-            "detail_link": activity.get("detail_url"),
-            "days": activity.get("days_of_week", "")
-        }
+        return self.days_of_week is not None or self.min_age is not None or self.max_age is not None
 
-    def dedeup_activities(self):
+    def matches_filters(self, activity):
         """
-        Deduplicates activities by grouping multiple sessions of the same activity.
+        Applies the day and age filters locally, upstream matches them loosely.
         """
-        # List of grouped activities
-        grouped = {}
+        return matches_days(activity, self.days_of_week) and matches_ages(activity, self.min_age, self.max_age)
 
-        for activity in self.activities:
-            # Determine uniqueness using name/location/category/age description
-            key = (
-                activity["name"],
-                activity["location"],
-                activity["category"],
-                activity["age_description"]
-            )
+    def load_park_distances(self, locations):
+        """
+        Makes sure park_distances covers the given park names.
+        """
+        missing = set(locations) - self.park_distances.keys()
+        if missing:
+            self.park_distances.update(park_distances(self.location, missing))
 
-            # Create new "group" if not found
-            if key not in grouped:
-                grouped[key] = self.initialize_group(activity)
+    def distance_key(self, activity):
+        """
+        Sort key placing activities at the nearest parks first.
+        """
+        return self.park_distances.get(activity.location, math.inf)
 
-            # Within that key grouping, add a session of the activity
-            grouped[key]["sessions"].append(self.build_session(activity))
+    def merge_groups(self, grouper, activities):
+        """
+        Merges parsed activities into a grouper, placing new groups nearest park first
+        when a location is known.
 
-        
-        # Replace activities with grouped activities
-        self.activities = []
-        for activity in grouped.values():
-            # For each grouped activity, sort the sessions
-            sorted_sessions = self.build_sorted_sessions_list(activity["sessions"])
-            date_ranges, time_ranges, action_links, detail_links, days_list = self.unpack_sessions(sorted_sessions)
-            del activity["sessions"] 
+        Returns:
+            list: The grouped activities that were created or changed.
+        """
+        order_key = None
+        if self.has_location():
+            self.load_park_distances({activity.location for activity in activities if activity.location})
+            order_key = self.distance_key
 
-            # Set lists of dates/times/links/days of week for activity
-            activity["date_ranges"] = date_ranges
-            activity["time_ranges"] = time_ranges
-            activity["action_links"] = action_links
-            activity["detail_links"] = detail_links
-            activity["days"] = days_list
+        with span("group"):
+            changed = grouper.add(activities, order_key=order_key)
+            return grouper.grouped(changed)
 
-            self.activities.append(activity)
+    def dedeup_activities(self, grouper=None):
+        """
+        Deduplicates activities by grouping multiple sessions of the same activity.
+        Pass the grouper from earlier batches of the same search to merge into it;
+        self.activities then holds only the groups this batch created or changed.
+        """
+        self.grouper = grouper if grouper is not None else ActivityGrouper()
+        self.activities = self.merge_groups(self.grouper, self.activities)
 
-    def get_activities(self):
+    async def cache_call(self, method, *args, **kwargs):
         """
-        Main function that executes the scraping of activities based on filters.
+        Calls a page cache method, off the event loop if the cache is shared through
+        SQLite, so waiting on another worker's write does not stall every search of this one.
         """
+        if self.page_cache.blocking:
+            return await run_blocking(method, *args, **kwargs)
+        return method(*args, **kwargs)
 
-        self.set_payload()
+    @staticmethod
+    def unpack_page(entry):
+        """
+        Splits a page cache entry into (raw activity items, total pages or None),
+        (None, None) for a miss. Entries cached before page counts were kept are item lists.
+        """
+        if entry is None:
+            return None, None
+        if isinstance(entry, list):
+            return entry, None
+        return entry["items"], entry.get("total_pages")
 
-        # Loop through 5 pages of results (100 results)
-        for page_num in range(self.first_page, self.first_page + self.MAX_PAGES_PER_SCRAPE):
+    async def fetch_page(self, client, semaphore, page_num):
+        """
+        Fetches a single page of results and returns its raw activity items.
+        Concurrent searches asking for the same page share one upstream request.
+        """
+        headers = self.build_headers(page_num)
+        key = self.cache_key(headers)
+
+        # Serve a recent identical request from the cache
+        if self.use_cache:
+            items, total_pages = self.unpack_page(await self.cache_call(self.page_cache.get, key))
+            if items is not None:
+                if total_pages is not None:
+                    self.total_pages = total_pages
+                return items
+
+        items, stale, total_pages = await self.in_flight.run(
+            key, lambda: self.fetch_page_upstream(client, semaphore, headers, key)
+        )
+        if stale:
+            self.degraded = True
+        if total_pages is not None:
+            self.total_pages = total_pages
+        return items
+
+    async def fetch_page_upstream(self, client, semaphore, headers, key):
+        """
+        Requests one page from upstream, falling back to an expired cached copy if upstream is unavailable.
 
-            # Make request, confirm that response has items
-            response = httpx.post(self.base_url, headers=self.build_headers(page_num), json=self.payload)
-            data = response.json()
+        Returns:
+            tuple: (raw activity items, whether they came from the stale cache,
+                    total pages of the search as reported by upstream or None).
+        """
+        async with self.in_flight.worker_lock(key) as waited:
+            if waited and self.use_cache:
+                # Another worker fetched this page while we waited on its lock
+                items, total_pages = self.unpack_page(await self.cache_call(self.page_cache.get, key))
+                if items is not None:
+                    return items, False, total_pages
+
+            try:
+                async with semaphore:
+                    with span("upstream"):
+                        data, nbytes = await self.upstream.post(client, self.base_url, headers, self.payload)
+            except UpstreamUnavailable:
+                entry = await self.cache_call(self.page_cache.get, key, allow_stale=True) if self.use_cache else None
+                items, total_pages = self.unpack_page(entry)
+                if items is None:
+                    raise
+                metrics.inc("upstream_stale_pages_total")
+                return items, True, total_pages
+
+            count_upstream(1, nbytes)
             items = data.get("body", {}).get("activity_items", [])
-            if not items:
-                break
-
-            # Parse activity and append to activities list
-            for activity_data in items:
-                self.activities.append(self.parse_activity(activity_data))
-
-            if len(items) < self.RECORDS_PER_PAGE:
-                # If reached end of results, break out of loop
-                break
-            elif page_num == self.first_page + self.MAX_PAGES_PER_SCRAPE - 1 and len(items) == self.RECORDS_PER_PAGE:
-                # Got max results on last page, assume there are more results to fetch
-                self.more_results_to_fetch = True
-            else:
-                # Otherwise sleep and iterate
-                sleep(1)
+            total_pages = (data.get("headers") or {}).get("page_info", {}).get("total_page")
+            if not isinstance(total_pages, int):
+                total_pages = None
+
+            if self.use_cache:
+                # Keep the page count with the page, so a search served from the cache skips empty pages too
+                await self.cache_call(self.page_cache.set, key, {"items": items, "total_pages": total_pages})
+            return items, False, total_pages
+
+    @asynccontextmanager
+    async def http_client(self):
+        """
+        Yields the worker's shared, pooled client when running on its background loop,
+        otherwise (e.g. under asyncio.run) a client of its own, closed afterwards.
+        """
+        if background.is_current():
+            yield background.client(self.REQUEST_TIMEOUT)
+            return
+        async with httpx.AsyncClient(timeout=self.REQUEST_TIMEOUT) as client:
+            yield client
+
+    async def iter_pages_async(self):
+        """
+        Fetches up to MAX_PAGES_PER_SCRAPE pages concurrently, yielding each page's
+        parsed activities (after the local filters) in page order as soon as it arrives.
+        Searches narrowed by days or ages fetch their first page alone and only
+        request the further pages upstream says exist.
+        """
+        self.set_payload()
+
+        # Radius search with no parks inside it, nothing to fetch
+        if self.no_matching_parks:
+            return
+
+        page_nums = range(self.first_page, self.first_page + self.MAX_PAGES_PER_SCRAPE)
+        last_page = page_nums[-1]
+
+        # Semaphore is FIFO, so pages are sent in order and at most max_concurrency at a time
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async with self.http_client() as client:
+            tasks = {}
+
+            def start(numbers):
+                for number in numbers:
+                    tasks[number] = asyncio.create_task(self.fetch_page(client, semaphore, number))
+
+            start(page_nums[:1] if self.is_narrowed() else page_nums)
+            try:
+                for page_num in page_nums:
+                    if page_num not in tasks:
+                        if self.total_pages is not None and page_num > self.total_pages:
+                            break
+                        start(number for number in page_nums
+                              if number >= page_num and (self.total_pages is None or number <= self.total_pages))
+                    try:
+                        items = await tasks[page_num]
+                    except UpstreamUnavailable:
+                        if page_num == self.first_page:
+                            raise
+                        # Keep the pages already fetched, load more retries from the one that failed
+                        self.more_results_to_fetch = True
+                        self.next_page = page_num
+                        self.degraded = True
+                        break
+
+                    # Confirm that response has items
+                    if not items:
+                        break
+
+                    # Parse activity and append to activities list
+                    page = [self.parse_activity(activity_data) for activity_data in items]
+                    if self.is_narrowed():
+                        page = [activity for activity in page if self.matches_filters(activity)]
+                    self.activities.extend(page)
+
+                    if page_num == last_page and len(items) == self.RECORDS_PER_PAGE:
+                        # Got max results on last page, assume there are more results to fetch
+                        self.more_results_to_fetch = True
+                        self.next_page = page_num + 1
+
+                    yield page
+
+                    if len(items) < self.RECORDS_PER_PAGE:
+                        # If reached end of results, stop consuming pages
+                        break
+            finally:
+                # Drop any pages past the end of results that are still queued or in flight
+                for task in tasks.values():
+                    task.cancel()
+                await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+    async def get_activities_async(self):
+        """
+        Fetches all pages of the batch into self.activities.
+        """
+        async for _ in self.iter_pages_async():
+            pass
+
+    def iter_pages(self):
+        """
+        Generator version of iter_pages_async for synchronous callers, running on the
+        worker's background loop. Pages already requested keep downloading while the
+        caller handles the previous one.
+        """
+        pages = self.iter_pages_async()
+        try:
+            while True:
+                try:
+                    page = background.run(pages.__anext__())
+                except StopAsyncIteration:
+                    return
+                yield page
+        finally:
+            background.run(pages.aclose())
+
+    def get_activities(self):
+        """
+        Main function that executes the scraping of activities based on filters.
+        The calling thread waits while the pages are fetched on the worker's background loop.
+        """
+        with span("scrape"):
+            background.run(self.get_activities_async())
 
     def __str__(self):
-        return json.dumps(self.activities, indent=2)
+        return json.dumps(self.activities, indent=2, default=encode_record)
@@ -0,0 +1,127 @@
+import asyncio
+import concurrent.futures
+import fcntl
+import hashlib
+import os
+import threading
+import time
+from contextlib import asynccontextmanager
+
+from app.metrics import registry as metrics
+
+# Defaults, overridable through the environment
+SINGLE_FLIGHT_LOCK_DIR = os.environ.get("SINGLE_FLIGHT_LOCK_DIR") # Set (with PAGE_CACHE_PATH) to coalesce across workers
+SINGLE_FLIGHT_LOCK_STRIPES = 256 # Lock files shared by all keys, keys hashing alike wait on each other
+SINGLE_FLIGHT_LOCK_WAIT = 30 # Seconds to wait on another worker's fetch before fetching anyway
+SINGLE_FLIGHT_POLL = 0.02 # Seconds between attempts to take a busy lock
+
+
+class LeaderCancelled(Exception):
+    """
+    Given to waiters when the call they were waiting on was cancelled, so they run it themselves.
+    """
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time. Callers arriving while a call for their
+    key is in flight wait for it and share its result instead of repeating it.
+    Within a worker, searches run on its one background event loop, but callers on
+    other loops (e.g. a CLI under asyncio.run) are handled too, since waiters share
+    a thread-safe future rather than a loop's.
+
+    Between workers there is no shared loop or memory: with a lock_dir, callers in
+    different worker processes take turns per key through file locks, so a caller
+    that waited can find the result in the shared page cache.
+    """
+
+    def __init__(self, lock_dir=SINGLE_FLIGHT_LOCK_DIR, stripes=SINGLE_FLIGHT_LOCK_STRIPES,
+                 lock_wait=SINGLE_FLIGHT_LOCK_WAIT):
+        self.lock_dir = lock_dir
+        self.stripes = stripes
+        self.lock_wait = lock_wait
+        self._calls = {} # key -> concurrent.futures.Future of the call in flight
+        self._lock = threading.Lock()
+        if self.lock_dir:
+            os.makedirs(self.lock_dir, exist_ok=True)
+
+    async def run(self, key, call):
+        """
+        Awaits call() unless a call for key is already in flight, in which case its result is shared.
+
+        Args:
+            key (str): Identifies identical calls.
+            call (callable): Returns the coroutine to run when this caller leads.
+
+        Returns:
+            The call's result.
+        """
+        while True:
+            with self._lock:
+                future = self._calls.get(key)
+                leader = future is None
+                if leader:
+                    future = self._calls[key] = concurrent.futures.Future()
+
+            if not leader:
+                metrics.inc("single_flight_shared_total", scope="worker")
+                try:
+                    # Shielded, so a waiter being cancelled does not cancel the call for everyone
+                    return await asyncio.shield(asyncio.wrap_future(future))
+                except LeaderCancelled:
+                    continue
+
+            try:
+                result = await call()
+            except asyncio.CancelledError:
+                future.set_exception(LeaderCancelled())
+                raise
+            except BaseException as error:
+                future.set_exception(error)
+                raise
+            else:
+                future.set_result(result)
+                return result
+            finally:
+                with self._lock:
+                    if self._calls.get(key) is future:
+                        del self._calls[key]
+
+    def _lock_path(self, key):
+        stripe = int(hashlib.sha1(key.encode("utf-8")).hexdigest(), 16) % self.stripes
+        return os.path.join(self.lock_dir, f"{stripe:03d}.lock")
+
+    @asynccontextmanager
+    async def worker_lock(self, key):
+        """
+        Holds key's cross-worker file lock, if enabled.
+
+        Yields:
+            bool: Whether another worker held the lock first, so a shared cache may now have the result.
+        """
+        if not self.lock_dir:
+            yield False
+            return
+
+        fd = os.open(self._lock_path(key), os.O_RDWR | os.O_CREAT, 0o644)
+        waited = False
+        deadline = time.monotonic() + self.lock_wait
+        locked = False
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    locked = True
+                    break
+                except BlockingIOError:
+                    waited = True
+                    if time.monotonic() >= deadline:
+                        break
+                    await asyncio.sleep(SINGLE_FLIGHT_POLL)
+            if waited:
+                metrics.inc("single_flight_shared_total", scope="host")
+            yield waited
+        finally:
+            if locked:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
@@ -0,0 +1,206 @@
+import argparse
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+from app.database_utils import get_catalog
+from app.db import DB_PATH, read_connection, write_connection
+from app.records import Activity
+from app.scrape import ActivityScraper
+
+SNAPSHOT_MAX_AGE = timedelta(hours=6) # Older snapshots are ignored in favor of live scraping
+SNAPSHOT_MIN_OPEN_SLOTS = 1 # Crawl only keeps activities with at least this many open spots
+
+# Columns stored per session, in parse_activity key order
+COLUMNS = [
+    "activity_id", "name", "description", "age_description", "category", "date_range",
+    "time_range", "location", "detail_url", "action_link", "days_of_week", "open_spots"
+]
+
+
+def create_snapshot_tables(conn):
+    """
+    Creates the snapshot tables, their indexes and the full text index if missing.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the activities database.
+    """
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS snapshot_activities (
+            id INTEGER PRIMARY KEY,
+            activity_id INTEGER,
+            name TEXT,
+            description TEXT,
+            age_description TEXT,
+            category TEXT,
+            date_range TEXT,
+            time_range TEXT,
+            location TEXT,
+            detail_url TEXT,
+            action_link TEXT,
+            days_of_week TEXT,
+            open_spots INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS snapshot_activities_location ON snapshot_activities(location);
+        CREATE INDEX IF NOT EXISTS snapshot_activities_category ON snapshot_activities(category);
+        CREATE INDEX IF NOT EXISTS snapshot_activities_open_spots ON snapshot_activities(open_spots);
+        CREATE INDEX IF NOT EXISTS snapshot_activities_activity_id ON snapshot_activities(activity_id);
+
+        CREATE TABLE IF NOT EXISTS snapshot_age_groups (
+            activity_id INTEGER,
+            age_group TEXT,
+            PRIMARY KEY (age_group, activity_id)
+        ) WITHOUT ROWID;
+
+        CREATE VIRTUAL TABLE IF NOT EXISTS snapshot_activities_fts USING fts5(
+            name, description, content='snapshot_activities', content_rowid='id'
+        );
+
+        CREATE TABLE IF NOT EXISTS snapshot_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """)
+
+
+def crawl_all(**filters):
+    """
+    Pages through every upstream result for the given scraper filters. A batch cut
+    short by upstream is continued from the page that failed, so the crawl either
+    returns every session or raises.
+
+    Returns:
+        list: Parsed (ungrouped) activities, one per session.
+
+    Raises:
+        UpstreamUnavailable: If a page could not be fetched even when retried.
+    """
+    activities = []
+    first_page = 1
+    while True:
+        scraper = ActivityScraper(first_page=first_page, use_cache=False, **filters)
+        scraper.get_activities()
+        activities.extend(scraper.activities)
+        if not scraper.more_results_to_fetch:
+            return activities
+        first_page = scraper.next_page
+
+
+def take_snapshot(db_path=DB_PATH):
+    """
+    Crawls the full upstream catalog and replaces the snapshot tables in one transaction.
+    Age groups are not part of the upstream records, so each one is crawled separately
+    to tag the sessions it returns.
+
+    Args:
+        db_path (str): Path to the activities database.
+
+    Returns:
+        int: Number of sessions stored.
+    """
+    age_groups = get_catalog(db_path).age_groups
+
+    activities = crawl_all(open_slots=SNAPSHOT_MIN_OPEN_SLOTS)
+    age_group_rows = []
+    for age_group in age_groups:
+        for activity in crawl_all(open_slots=SNAPSHOT_MIN_OPEN_SLOTS, age_groups=[age_group]):
+            age_group_rows.append((activity.id, age_group))
+
+    # Activity fields are stored in COLUMNS order
+    rows = [activity.to_row() for activity in activities]
+
+    conn = write_connection(db_path)
+    try:
+        create_snapshot_tables(conn)
+        with conn:
+            conn.execute("DELETE FROM snapshot_activities")
+            conn.execute("DELETE FROM snapshot_age_groups")
+            conn.executemany(
+                f"INSERT INTO snapshot_activities ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                rows
+            )
+            conn.executemany("INSERT OR IGNORE INTO snapshot_age_groups VALUES (?, ?)", age_group_rows)
+            conn.execute("INSERT INTO snapshot_activities_fts(snapshot_activities_fts) VALUES ('rebuild')")
+            conn.execute(
+                "INSERT OR REPLACE INTO snapshot_meta VALUES ('taken_at', ?)",
+                (datetime.now().isoformat(timespec="seconds"),)
+            )
+    finally:
+        conn.close()
+    return len(rows)
+
+
+def snapshot_taken_at(db_path=DB_PATH):
+    """
+    Returns when the snapshot was taken, or None if no snapshot exists.
+    """
+    try:
+        row = read_connection(db_path).execute("SELECT value FROM snapshot_meta WHERE key = 'taken_at'").fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return datetime.fromisoformat(row[0]) if row else None
+
+
+def snapshot_is_fresh(taken_at, max_age=SNAPSHOT_MAX_AGE):
+    """
+    Checks whether a snapshot taken at taken_at is recent enough to serve searches.
+    """
+    return taken_at is not None and datetime.now() - taken_at <= max_age
+
+
+def search_snapshot(parks=[], categories=[], age_groups=[], open_slots=1, keywords=None, db_path=DB_PATH):
+    """
+    Answers a search from the local snapshot, returning every match.
+
+    Args:
+        parks (list): Park/facility names to include, all if empty.
+        categories (list): Activity category names to include, all if empty.
+        age_groups (list): Age group names to include, all if empty.
+        open_slots (int): Minimum number of open spots.
+        keywords (str): Optional full text query over name and description.
+        db_path (str): Path to the activities database.
+
+    Returns:
+        list: Activities in the same format as ActivityScraper.parse_activity.
+    """
+    conditions = ["(open_spots IS NULL OR open_spots >= ?)"]
+    params = [open_slots]
+
+    for column, values in (("location", parks), ("category", categories)):
+        if values:
+            conditions.append(f"{column} IN ({','.join('?' * len(values))})")
+            params.extend(values)
+
+    if age_groups:
+        conditions.append(f"""activity_id IN (
+            SELECT activity_id FROM snapshot_age_groups
+            WHERE age_group IN ({','.join('?' * len(age_groups))})
+        )""")
+        params.extend(age_groups)
+
+    if keywords:
+        conditions.append("id IN (SELECT rowid FROM snapshot_activities_fts WHERE snapshot_activities_fts MATCH ?)")
+        params.append(keywords)
+
+    rows = read_connection(db_path).execute(f"""
+        SELECT {', '.join(COLUMNS)}
+        FROM snapshot_activities
+        WHERE {' AND '.join(conditions)}
+        ORDER BY name, id
+    """, params).fetchall()
+
+    return [Activity.from_row(row) for row in rows]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crawl the full activity catalog into the local snapshot tables.")
+    parser.add_argument("--db", default=DB_PATH, help="Path to the activities database")
+    parser.add_argument("--interval", type=int, default=0, help="Re-crawl every N seconds (0 to crawl once)")
+    args = parser.parse_args()
+
+    while True:
+        count = take_snapshot(args.db)
+        print(f"Stored {count} sessions in snapshot at {datetime.now():%Y-%m-%d %H:%M:%S}")
+        if not args.interval:
+            break
+        time.sleep(args.interval)
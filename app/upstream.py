@@ -0,0 +1,305 @@
+import asyncio
+import os
+import random
+import threading
+import time
+
+import httpx
+
+from app.aio import run_blocking
+from app.db import write_connection
+from app.metrics import registry as metrics
+
+# Defaults, overridable through the environment
+UPSTREAM_RATE = float(os.environ.get("UPSTREAM_RATE", 10)) # Max requests per second to upstream, across workers
+UPSTREAM_MIN_RATE = float(os.environ.get("UPSTREAM_MIN_RATE", 1)) # Floor the rate backs off to after 429s
+UPSTREAM_RATE_STEP = float(os.environ.get("UPSTREAM_RATE_STEP", 0.5)) # Requests per second regained per success
+UPSTREAM_BURST = int(os.environ.get("UPSTREAM_BURST", 10)) # Requests allowed at once after an idle spell
+UPSTREAM_MAX_WAIT = float(os.environ.get("UPSTREAM_MAX_WAIT", 10)) # Seconds a request may queue for the limiter
+UPSTREAM_LIMITER_PATH = os.environ.get("UPSTREAM_LIMITER_PATH", "instance/upstream.db") # Empty limits per worker
+UPSTREAM_RETRIES = int(os.environ.get("UPSTREAM_RETRIES", 3)) # Retries after the first attempt
+UPSTREAM_BACKOFF = 0.5 # Seconds, doubled on every retry before jitter
+UPSTREAM_MAX_BACKOFF = 8 # Cap on a single backoff, in seconds
+BREAKER_FAILURES = 5 # Consecutive failed pages that open the circuit
+BREAKER_RESET = 30 # Seconds the circuit stays open before a trial request
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class UpstreamUnavailable(Exception):
+    """
+    Raised when a page could not be fetched from upstream, after retries or because the circuit is open.
+    """
+
+
+class TokenBucket:
+    """
+    Token bucket whose refill rate adapts to upstream: halved on every 429 and
+    raised by a small step on every success, up to max_rate. Requests reserve a
+    token and wait until it is theirs, so queued requests go out evenly spaced.
+    """
+    blocking = False # Whether calls can wait on other processes, see SQLiteTokenBucket
+
+    def __init__(self, max_rate=UPSTREAM_RATE, min_rate=UPSTREAM_MIN_RATE, step=UPSTREAM_RATE_STEP,
+                 burst=UPSTREAM_BURST, max_wait=UPSTREAM_MAX_WAIT):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.step = step
+        self.burst = burst
+        self.max_wait = max_wait
+        self._state = (float(burst), max_rate, time.time()) # tokens, rate, updated_at
+        self._lock = threading.Lock()
+
+    def _reserve(self, state, now):
+        """
+        Takes a token from state, returning (new state, seconds to wait) or (state, None) if the wait is too long.
+        """
+        tokens, rate, updated_at = state
+        tokens = min(self.burst, tokens + (now - updated_at) * rate)
+        wait = max(0.0, (1 - tokens) / rate)
+        if wait > self.max_wait:
+            return (tokens, rate, now), None
+        return (tokens - 1, rate, now), wait
+
+    def _adjust(self, state, ok):
+        tokens, rate, updated_at = state
+        rate = min(self.max_rate, rate + self.step) if ok else max(self.min_rate, rate / 2)
+        return tokens, rate, updated_at
+
+    def reserve(self):
+        """
+        Reserves the next request slot.
+
+        Returns:
+            float: Seconds to wait before sending, or None if the queue is too long to wait.
+        """
+        with self._lock:
+            self._state, wait = self._reserve(self._state, time.time())
+            return wait
+
+    def feedback(self, ok):
+        """
+        Adapts the rate: ok=False after a 429, ok=True after a success.
+        """
+        with self._lock:
+            self._state = self._adjust(self._state, ok)
+
+    @property
+    def rate(self):
+        return self._state[1]
+
+
+class SQLiteTokenBucket(TokenBucket):
+    """
+    TokenBucket kept in a local SQLite file, so all gunicorn workers on the host
+    share one budget instead of each sending at the full rate.
+    """
+    blocking = True # Each call waits for the file's write lock
+
+    def __init__(self, path, name="upstream", **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.name = name
+
+        conn = self._connect()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS token_buckets (
+                name TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                rate REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        conn.execute("INSERT OR IGNORE INTO token_buckets VALUES (?, ?, ?, ?)",
+                     (self.name, float(self.burst), self.max_rate, time.time()))
+
+    def _connect(self):
+        return write_connection(self.path, per_thread=True)
+
+    def _update(self, change):
+        """
+        Applies change(state) to the shared row in one write transaction, returning change's extra result.
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            state = conn.execute(
+                "SELECT tokens, rate, updated_at FROM token_buckets WHERE name = ?", (self.name,)
+            ).fetchone()
+            state, result = change(state)
+            conn.execute("UPDATE token_buckets SET tokens = ?, rate = ?, updated_at = ? WHERE name = ?",
+                         (*state, self.name))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return result
+
+    def reserve(self):
+        return self._update(lambda state: self._reserve(state, time.time()))
+
+    def feedback(self, ok):
+        self._update(lambda state: (self._adjust(state, ok), None))
+
+    @property
+    def rate(self):
+        row = self._connect().execute("SELECT rate FROM token_buckets WHERE name = ?", (self.name,)).fetchone()
+        return row[0]
+
+
+class CircuitBreaker:
+    """
+    Stops sending to upstream after repeated failures. After reset_timeout one trial
+    request is let through; its success closes the circuit again.
+    """
+
+    def __init__(self, failures=BREAKER_FAILURES, reset_timeout=BREAKER_RESET):
+        self.failure_threshold = failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_started = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """
+        Returns whether a request may be sent now.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            now = time.monotonic()
+            # A trial that never reported back (e.g. cancelled) is retried after another reset_timeout
+            trial_due = self._trial_started is None or now - self._trial_started >= self.reset_timeout
+            if now - self.opened_at >= self.reset_timeout and trial_due:
+                self._trial_started = now
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_started = None
+
+    def release_trial(self):
+        """
+        Lets another request be the trial, when this one ended without telling whether upstream recovered.
+        """
+        with self._lock:
+            self._trial_started = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_started = None
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    metrics.inc("upstream_circuit_opened_total")
+                self.opened_at = time.monotonic()
+
+
+def backoff_delay(attempt, retry_after=None):
+    """
+    Full-jitter exponential backoff, never shorter than a Retry-After from upstream.
+    """
+    delay = random.uniform(0, min(UPSTREAM_MAX_BACKOFF, UPSTREAM_BACKOFF * 2 ** attempt))
+    if retry_after:
+        try:
+            delay = max(delay, min(float(retry_after), UPSTREAM_MAX_BACKOFF))
+        except ValueError:
+            pass
+    return delay
+
+
+class Upstream:
+    """
+    Sends page requests to the activities API through a shared rate limit, retrying
+    throttled, failed, timed out and malformed responses with backoff, behind a
+    circuit breaker.
+    """
+
+    def __init__(self, limiter, breaker=None, retries=UPSTREAM_RETRIES):
+        self.limiter = limiter
+        self.breaker = breaker or CircuitBreaker()
+        self.retries = retries
+
+    async def _limiter_call(self, method, *args):
+        # A shared limiter's write lock may be held by another worker, wait for it off the loop
+        if self.limiter.blocking:
+            return await run_blocking(method, *args)
+        return method(*args)
+
+    async def post(self, client, url, headers, payload):
+        """
+        Posts one page request.
+
+        Returns:
+            tuple: (parsed JSON response, bytes received).
+
+        Raises:
+            UpstreamUnavailable: If the circuit is open, the limiter queue is full or all attempts failed.
+        """
+        if not self.breaker.allow():
+            raise UpstreamUnavailable("Upstream circuit is open")
+
+        for attempt in range(self.retries + 1):
+            wait = await self._limiter_call(self.limiter.reserve)
+            if wait is None:
+                # Too many requests queued, failing fast beats waiting past the client's patience
+                metrics.inc("upstream_failures_total", reason="queue_full")
+                raise UpstreamUnavailable("Upstream rate limit queue is full")
+            if wait:
+                await asyncio.sleep(wait)
+
+            retry_after = None
+            try:
+                response = await client.post(url, headers=headers, json=payload)
+                if response.status_code in RETRY_STATUSES:
+                    reason = str(response.status_code)
+                    retry_after = response.headers.get("Retry-After")
+                    if response.status_code == 429:
+                        await self._limiter_call(self.limiter.feedback, False)
+                else:
+                    response.raise_for_status()
+                    data = response.json()
+                    if not isinstance(data, dict):
+                        raise ValueError("Unexpected response body")
+                    await self._limiter_call(self.limiter.feedback, True)
+                    self.breaker.record_success()
+                    return data, len(response.content)
+            except httpx.TimeoutException:
+                reason = "timeout"
+            except httpx.HTTPStatusError as error:
+                # Other 4xx, a retry would get the same answer. It is this request that
+                # upstream rejected, which says nothing about its health or our rate
+                self.breaker.release_trial()
+                metrics.inc("upstream_failures_total", reason=str(error.response.status_code))
+                raise UpstreamUnavailable(f"Upstream answered {error.response.status_code}") from error
+            except httpx.TransportError:
+                reason = "connection"
+            except ValueError:
+                # Includes json.JSONDecodeError
+                reason = "bad_json"
+
+            if attempt < self.retries:
+                metrics.inc("upstream_retries_total", reason=reason)
+                await asyncio.sleep(backoff_delay(attempt, retry_after))
+
+        self.breaker.record_failure()
+        metrics.inc("upstream_failures_total", reason=reason)
+        raise UpstreamUnavailable(f"Upstream failed after {self.retries + 1} attempts ({reason})")
+
+
+def build_upstream(path=UPSTREAM_LIMITER_PATH):
+    """
+    Builds the upstream sender, with its rate limit shared through path if given, otherwise per worker.
+    """
+    if path:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        return Upstream(SQLiteTokenBucket(path))
+    return Upstream(TokenBucket())
@@ -0,0 +1,275 @@
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from app.database_utils import get_catalog
+from app.db import DB_PATH
+from app.filters import matches_ages, matches_days
+
+API_PATH = "/chicagoparkdistrict/rest/activities/list"
+
+# Upstream abbreviates facility names, ActivityScraper expands them back
+ABBREVIATIONS = [(" Center", " Ctr"), (" Park", " Pk"), (" Field", " Fld"), (" Community", " Cmty")]
+
+DATE_RANGES = [
+    "June 3, 2025 to Aug 12, 2025", "June 9, 2025 to July 28, 2025", "Sep 6, 2025 to Nov 15, 2025",
+    "July 1, 2025", "Aug 16, 2025", "Oct 4, 2025"
+]
+TIME_RANGES = ["9:00 AM - 10:00 AM", "10:30 AM - 11:15 AM", "Noon - 1:00 PM", "4:00 PM - 5:30 PM", "6:30 PM - 8:00 PM"]
+DAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun", "Mon,Wed", "Tue,Thu", "Sat,Sun"]
+AGE_DESCRIPTIONS = ["3 - 5 yrs", "6 - 12 yrs", "13 - 17 yrs", "18 yrs +", "55 yrs +", "All ages"]
+
+
+def abbreviate(name):
+    """
+    Turns a park name into the abbreviated label upstream uses.
+    """
+    for full, short in ABBREVIATIONS:
+        name = name.replace(full, short)
+    return name
+
+
+def synthetic_items(records=2000, sessions_per_activity=4, seed=0, db_path=DB_PATH):
+    """
+    Generates upstream-shaped activity items at the parks, categories and age groups
+    of the local database, several sessions per activity so results need grouping.
+
+    Args:
+        records (int): Number of items (sessions) to generate.
+        sessions_per_activity (int): Average sessions sharing a name, park and category.
+        seed (int): Random seed, the same seed gives the same items.
+        db_path (str): Path to the activities database.
+
+    Returns:
+        list: Items as in the "activity_items" of an upstream response, ordered by name.
+            Each item also has the ids used to filter it, under "_filter".
+    """
+    rng = random.Random(seed)
+    catalog = get_catalog(db_path)
+    parks = sorted(catalog.park_ids.items())
+    categories = [(name, catalog.activity_ids[name]) for name in catalog.categories]
+    age_groups = [(name, catalog.activity_ids[name]) for name in catalog.age_groups]
+
+    items = []
+    for number in range(math.ceil(records / sessions_per_activity)):
+        park_name, park_id = rng.choice(parks)
+        category, category_id = rng.choice(categories)
+        _, age_group_id = rng.choice(age_groups)
+        name = f"{category.split(' - ')[0]} {number:05d}"
+        description = f"<p>{name} at {park_name}.</p>" + " Bring water and comfortable clothes." * rng.randint(1, 6)
+        age_description = rng.choice(AGE_DESCRIPTIONS)
+
+        for _ in range(rng.randint(1, 2 * sessions_per_activity - 1)):
+            activity_id = len(items) + 1
+            items.append({
+                "id": activity_id,
+                "name": name,
+                "desc": description,
+                "age_description": age_description,
+                "category": category,
+                "date_range": rng.choice(DATE_RANGES),
+                "time_range": rng.choice(TIME_RANGES),
+                "location": {"label": abbreviate(park_name)},
+                "detail_url": f"https://example.invalid/activity/search/detail/{activity_id}",
+                "action_link": {"href": f"https://example.invalid/activity/enroll/{activity_id}"},
+                "days_of_week": rng.choice(DAYS),
+                "total_open": rng.randint(0, 12),
+                "_filter": {"center_id": park_id, "category_id": category_id, "age_group_id": age_group_id}
+            })
+            if len(items) == records:
+                break
+        if len(items) == records:
+            break
+
+    items.sort(key=lambda item: (item["name"], item["id"]))
+    return items
+
+
+def load_fixture(path):
+    """
+    Loads recorded items, either a list of activity items or a saved upstream response.
+    Recorded items have no "_filter" ids, so every search matches all of them.
+    """
+    with open(path) as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = data.get("body", {}).get("activity_items", [])
+    return data
+
+
+class _Item:
+    """
+    Attribute view of a raw item, for the filters in app.filters.
+    """
+    def __init__(self, item):
+        self.days_of_week = item.get("days_of_week")
+        self.age_description = item.get("age_description")
+
+
+def matches(item, pattern):
+    """
+    Applies the filters of an activity_search_pattern that the fake understands.
+    """
+    ids = item.get("_filter")
+    if ids is None:
+        return True
+    for field, key in (("center_ids", "center_id"),
+                       ("activity_other_category_ids", "category_id"),
+                       ("activity_category_ids", "age_group_id")):
+        wanted = pattern.get(field)
+        if wanted and ids[key] not in wanted:
+            return False
+    if pattern.get("days_of_week"):
+        wanted_days = {index for index, flag in enumerate(pattern["days_of_week"]) if flag == "1"}
+        if not matches_days(_Item(item), wanted_days):
+            return False
+    if not matches_ages(_Item(item), pattern.get("min_age"), pattern.get("max_age")):
+        return False
+    return item.get("total_open", 0) >= (pattern.get("open_spots") or 0)
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128 # Concurrent scrapers open many connections at once
+
+
+class FakeActivitiesAPI:
+    """
+    Serves items through the upstream contract: page_info request header in, paged
+    "activity_items" body and page_info response header out.
+    """
+
+    def __init__(self, items, latency=0.0, jitter=0.0, max_pages=None, host="127.0.0.1", port=0):
+        self.items = items
+        self.latency = latency # Seconds added to every page
+        self.jitter = jitter # Up to this many extra random seconds per page
+        self.max_pages = max_pages # Cap on pages of any search, None for all results
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self.server = _Server((host, port), self._handler_class())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}{API_PATH}?locale=en-US"
+
+    def respond(self, pattern, page_info):
+        """
+        Builds the response body for one page of a search.
+        """
+        per_page = int(page_info.get("total_records_per_page", 20))
+        page_number = int(page_info.get("page_number", 1))
+
+        found = [item for item in self.items if matches(item, pattern)]
+        total_pages = math.ceil(len(found) / per_page)
+        if self.max_pages is not None:
+            total_pages = min(total_pages, self.max_pages)
+            found = found[:total_pages * per_page]
+
+        start = (page_number - 1) * per_page
+        page = [
+            {key: value for key, value in item.items() if key != "_filter"}
+            for item in found[start:start + per_page]
+        ]
+        return {
+            "headers": {
+                "response_code": "0000",
+                "response_message": "Successful",
+                "page_info": {
+                    "order_by": page_info.get("order_by", "Name"),
+                    "page_number": page_number,
+                    "total_records_per_page": per_page,
+                    "total_records": len(found),
+                    "total_page": total_pages
+                }
+            },
+            "body": {"activity_items": page}
+        }
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # Keep connections alive like the real API
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if not self.path.startswith(API_PATH):
+                    self.send_error(404)
+                    return
+
+                page_info = json.loads(self.headers.get("page_info") or "{}")
+                pattern = body.get("activity_search_pattern", {})
+                data = json.dumps(api.respond(pattern, page_info)).encode("utf-8")
+
+                delay = api.latency + (random.uniform(0, api.jitter) if api.jitter else 0)
+                if delay:
+                    time.sleep(delay)
+
+                try:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json;charset=utf-8")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The scraper cancels pages past the end of results
+                    self.close_connection = True
+                    return
+
+                with api._lock:
+                    api.requests += 1
+                    api.bytes_sent += len(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        """
+        Serves in a background thread and returns the URL to use as ACTIVITIES_API_URL.
+        """
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the ActiveCommunities activities API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--records", type=int, default=2000, help="Synthetic items to serve")
+    parser.add_argument("--fixture", help="JSON file of recorded items to serve instead of synthetic ones")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every page")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Max random extra seconds per page")
+    parser.add_argument("--max-pages", type=int, help="Cap on the pages of any search")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--db", default=DB_PATH, help="Database to take parks and categories from")
+    args = parser.parse_args()
+
+    items = load_fixture(args.fixture) if args.fixture else synthetic_items(args.records, seed=args.seed, db_path=args.db)
+    api = FakeActivitiesAPI(items, latency=args.latency, jitter=args.jitter, max_pages=args.max_pages,
+                            host=args.host, port=args.port)
+    print(f"Serving {len(items)} activities at {api.url}")
+    try:
+        api.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        api.server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Chicago, roughly, for random search locations
+LAT_RANGE = (41.65, 42.02)
+LON_RANGE = (-87.85, -87.55)
+
+SCENARIOS = ["search", "search_stream", "load_more", "dedeup_activities", "get_activity_parks", "find_nearby_parks"]
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(name, latencies, elapsed):
+    """
+    Reduces per-call latencies (seconds) to throughput and latency percentiles (milliseconds).
+    """
+    latencies = sorted(latencies)
+    return {
+        "scenario": name,
+        "count": len(latencies),
+        "ops_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p90_ms": percentile(latencies, 0.90) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": latencies[-1] * 1000 if latencies else 0.0
+    }
+
+
+def run_scenario(name, call, iterations, concurrency, seed=0):
+    """
+    Times iterations calls of call(rng), spread over concurrency threads.
+    call may return a callable to time instead, after doing untimed setup itself.
+
+    Returns:
+        dict: The scenario summary, see summarize.
+    """
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(worker_id, count):
+        rng = random.Random(seed * 1000 + worker_id)
+        for _ in range(count):
+            start = time.perf_counter()
+            timed = call(rng)
+            if callable(timed):
+                # Only the returned callable counts, the rest was setup
+                start = time.perf_counter()
+                timed()
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    counts = [iterations // concurrency + (i < iterations % concurrency) for i in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(worker, i, count) for i, count in enumerate(counts)]:
+            future.result()
+    return summarize(name, latencies, time.perf_counter() - start)
+
+
+def checked(response):
+    """
+    Reads a test client response, failing the run on an error status so errors are not timed as results.
+    """
+    data = response.get_data()
+    if response.status_code >= 400:
+        raise RuntimeError(f"{response.request.path} returned {response.status_code}: {data[:200]!r}")
+    return data
+
+
+def format_report(summaries, api):
+    lines = [f"{'scenario':<20} {'count':>6} {'ops/s':>9} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}"]
+    for summary in summaries:
+        lines.append(
+            f"{summary['scenario']:<20} {summary['count']:>6} {summary['ops_per_sec']:>9.1f} "
+            f"{summary['p50_ms']:>9.2f} {summary['p90_ms']:>9.2f} {summary['p99_ms']:>9.2f} {summary['max_ms']:>9.2f}"
+        )
+    if api is not None:
+        lines.append(f"upstream pages served: {api.requests}, bytes: {api.bytes_sent}")
+    return "\n".join(lines)
+
+
+def compare(summaries, baseline_path, tolerance):
+    """
+    Compares p50 latencies with a saved run.
+
+    Returns:
+        list: Messages for scenarios slower than the baseline by more than tolerance.
+    """
+    with open(baseline_path) as f:
+        baseline = {summary["scenario"]: summary for summary in json.load(f)["scenarios"]}
+
+    regressions = []
+    for summary in summaries:
+        before = baseline.get(summary["scenario"])
+        if before and before["p50_ms"] and summary["p50_ms"] > before["p50_ms"] * (1 + tolerance):
+            regressions.append(
+                f"{summary['scenario']}: p50 {before['p50_ms']:.2f} ms -> {summary['p50_ms']:.2f} ms"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the app against a local fake of the activities API.")
+    parser.add_argument("--records", type=int, default=2000, help="Synthetic upstream items")
+    parser.add_argument("--fixture", help="JSON file of recorded items to serve instead of synthetic ones")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds the fake API adds to every page")
+    parser.add_argument("--jitter", type=float, default=0.01, help="Max random extra seconds per page")
+    parser.add_argument("--api-url", help="Use a fake API already running (python -m bench.fake_api) instead of "
+                                          "one in this process, so it does not compete with the app for the GIL")
+    parser.add_argument("--iterations", type=int, default=100, help="Calls per scenario")
+    parser.add_argument("--concurrency", type=int, default=4, help="Threads issuing requests to the app")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--cache", action="store_true", help="Keep the upstream page cache on")
+    parser.add_argument("--upstream-rate", type=float, default=1000,
+                        help="Upstream requests per second the rate limiter allows")
+    parser.add_argument("--db", help="Database to use instead of DB_PATH")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also write the report to this file")
+    parser.add_argument("--save", help="Save the results as JSON, to compare later runs against")
+    parser.add_argument("--compare", help="JSON results of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed p50 slowdown against --compare")
+    args = parser.parse_args()
+
+    # Configuration is read when the app modules are imported, so set it first
+    if args.db:
+        os.environ["DB_PATH"] = args.db
+    os.environ["RESULT_STORE_PATH"] = ""
+    os.environ["PREFETCH_NEXT_BATCH"] = "0"
+    os.environ["UPSTREAM_RATE"] = str(args.upstream_rate)
+    os.environ["UPSTREAM_BURST"] = str(max(1, int(args.upstream_rate)))
+    if not args.cache:
+        os.environ["PAGE_CACHE_TTL"] = "0"
+
+    from app.app import app
+    from app.database_utils import get_activity_parks, get_catalog
+    from app.db import DB_PATH
+    from app.scrape import ActivityScraper
+    from bench.fake_api import FakeActivitiesAPI, load_fixture, synthetic_items
+
+    items = load_fixture(args.fixture) if args.fixture else synthetic_items(args.records, seed=args.seed, db_path=DB_PATH)
+    if args.api_url:
+        api = None
+        ActivityScraper.API_URL = args.api_url
+    else:
+        api = FakeActivitiesAPI(items, latency=args.latency, jitter=args.jitter)
+        ActivityScraper.API_URL = api.start()
+
+    park_names = list(get_catalog(DB_PATH).park_ids)
+    clients = threading.local()
+
+    def client():
+        # One test client (and so one session) per thread
+        if not hasattr(clients, "client"):
+            clients.client = app.test_client()
+        return clients.client
+
+    def random_search(rng):
+        if rng.random() < 0.5:
+            return {"parks": rng.sample(park_names, min(8, len(park_names)))}
+        return {
+            "user_lat": str(rng.uniform(*LAT_RANGE)),
+            "user_lon": str(rng.uniform(*LON_RANGE)),
+            "distance": str(rng.choice([1, 2, 5]))
+        }
+
+    def search(rng):
+        app.config["STREAM_RESULTS"] = False
+        checked(client().post("/search", data=random_search(rng)))
+        checked(client().get("/results"))
+
+    def search_stream(rng):
+        app.config["STREAM_RESULTS"] = True
+        checked(client().post("/search", data=random_search(rng)))
+        checked(client().get("/results"))
+        checked(client().post("/search/stream"))
+
+    def load_more(rng):
+        # A search over everything, so there is always a next batch
+        app.config["STREAM_RESULTS"] = False
+        checked(client().post("/search", data={"open_slots": "1"}))
+        return lambda: checked(client().post("/load_more", json={"page": 1 + ActivityScraper.MAX_PAGES_PER_SCRAPE}))
+
+    # Parsed upstream records for the in-process scenarios
+    scraper = ActivityScraper()
+    parsed = [scraper.parse_activity(item) for item in items[:ActivityScraper.MAX_PAGES_PER_SCRAPE * ActivityScraper.RECORDS_PER_PAGE]]
+    scraper.activities = list(parsed)
+    scraper.dedeup_activities()
+    groups = scraper.activities
+
+    def dedeup_activities(rng):
+        scraper.activities = list(parsed)
+        scraper.dedeup_activities()
+
+    def activity_parks(rng):
+        get_activity_parks(groups)
+
+    def find_nearby_parks(rng):
+        checked(client().post("/find_nearby_parks", json={
+            "lat": rng.uniform(*LAT_RANGE), "lon": rng.uniform(*LON_RANGE), "radius": rng.choice([1, 2, 5])
+        }))
+
+    calls = {
+        "search": search,
+        "search_stream": search_stream,
+        "load_more": load_more,
+        "dedeup_activities": dedeup_activities,
+        "get_activity_parks": activity_parks,
+        "find_nearby_parks": find_nearby_parks
+    }
+    # Request scenarios go through the app concurrently, the in-process ones run on one thread
+    concurrency = {"dedeup_activities": 1, "get_activity_parks": 1}
+
+    summaries = []
+    try:
+        for name in args.scenarios:
+            summaries.append(run_scenario(name, calls[name], args.iterations,
+                                          concurrency.get(name, args.concurrency), seed=args.seed))
+            print(f"{name}: done", file=sys.stderr)
+    finally:
+        if api is not None:
+            api.stop()
+
+    report = format_report(summaries, api)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"args": vars(args), "scenarios": summaries}, f, indent=2)
+
+    if args.compare:
+        regressions = compare(summaries, args.compare, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,13 @@
+import os
+
+# Searches spend most of their time waiting on the Park District. That waiting runs on each
+# worker's event loop (app.aio) while the request's thread is parked, so threads are cheap
+# and one worker holds many searches in flight; more workers add CPU for grouping and rendering.
+worker_class = "gthread"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+threads = int(os.environ.get("GUNICORN_THREADS", 100)) # Requests in flight per worker
+
+# Streamed searches keep their thread until the last page is sent
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+graceful_timeout = 30
+keepalive = 5
@@ -246,6 +246,16 @@ const FilterManager = {
             summary.push(`<li><strong>Age Groups:</strong> ${ages.join(", ")}</li>`);
         }
 
+        const minAge = document.getElementById("min-age").value.trim();
+        const maxAge = document.getElementById("max-age").value.trim();
+        if (minAge || maxAge) {
+            const range = minAge && maxAge ? `${minAge} to ${maxAge}` : minAge ? `${minAge} and up` : `Up to ${maxAge}`;
+            summary.push(`<li><strong>Ages:</strong> ${range}</li>`);
+        }
+
+        const days = [...document.querySelectorAll('input[name="days_of_week"]:checked')].map(cb => cb.value);
+        summary.push(`<li><strong>Days:</strong> ${days.length ? days.join(", ") : "Any"}</li>`);
+
         summary.push("<li><strong>Parks/Facilities:</strong></li>");
         document.getElementById("form-summary").innerHTML = `<ul style="margin:0;padding-left:1rem;">${summary.join("")}</ul>`; // Display summary
     },
@@ -358,7 +368,17 @@ const DropdownManager = {
 
 // Initialize everything when the document is ready
 document.addEventListener("DOMContentLoaded", () => {
-    AppState.allParks = window.allParks || []; // Initialize parks list
+    // Load the parks list (cached by the browser until the database changes)
+    const parksLoaded = fetch(window.parksUrl)
+        .then(response => response.json())
+        .then(geojson => {
+            AppState.allParks = geojson.features.map(feature => ({
+                name: feature.properties.name,
+                latitude: feature.geometry.coordinates[1],
+                longitude: feature.geometry.coordinates[0]
+            }));
+        })
+        .catch(err => console.warn("Loading parks failed:", err));
 
     navigator.geolocation.getCurrentPosition(
         pos => {
@@ -366,18 +386,22 @@ document.addEventListener("DOMContentLoaded", () => {
             document.getElementById("user-lat").value = pos.coords.latitude;
             document.getElementById("user-lon").value = pos.coords.longitude;
 
-            MapManager.init(); // Initialize the map
-            ParkSelector.populateDropdown(); // Populate the parks dropdown
-            MapManager.addUserMarker(AppState.userLatLng); // Add the user marker
-            NearbyParks.loadNearby(); // Load nearby parks
-            NearbyParks.updateButtonLabel(); // Update the button label
+            parksLoaded.then(() => {
+                MapManager.init(); // Initialize the map
+                ParkSelector.populateDropdown(); // Populate the parks dropdown
+                MapManager.addUserMarker(AppState.userLatLng); // Add the user marker
+                NearbyParks.loadNearby(); // Load nearby parks
+                NearbyParks.updateButtonLabel(); // Update the button label
+            });
         },
         err => {
             console.warn("Geolocation failed:", err);
-            MapManager.init(); // Initialize the map even if geolocation fails
-            ParkSelector.populateDropdown(); // Populate the dropdown anyway
-            FilterManager.updateSummary(); // Update summary
-            NearbyParks.updateButtonLabel(); // Update button label
+            parksLoaded.then(() => {
+                MapManager.init(); // Initialize the map even if geolocation fails
+                ParkSelector.populateDropdown(); // Populate the dropdown anyway
+                FilterManager.updateSummary(); // Update summary
+                NearbyParks.updateButtonLabel(); // Update button label
+            });
         }
     );
 
@@ -391,5 +415,9 @@ document.addEventListener("DOMContentLoaded", () => {
         FilterManager.updateGroupToggles(); // Update group toggles
     });
 
+    // Keep the summary in step with the age and day filters
+    ["min-age", "max-age"].forEach(id => document.getElementById(id).addEventListener("input", FilterManager.updateSummary));
+    document.querySelectorAll('input[name="days_of_week"]').forEach(cb => cb.addEventListener("change", FilterManager.updateSummary));
+
     document.getElementById("clear-parks-btn").addEventListener("click", ParkSelector.clearSelection); // Clear parks selection
 });
@@ -6,29 +6,37 @@ let activityCards = new Map(); // Maps place names to activity card DOM elements
 // Get park data passed from the server into the page
 const parkData = window.parkData;
 
+// Popup contents for a park marker
+function markerPopup(name, activities) {
+  return `<strong>${name}</strong><br>${activities.map(a => `• ${a}`).join('<br>')}`;
+}
+
 // Render park markers on the map
 function renderMapMarkers(parkData) {
-  const bounds = [];
-
   parkData.forEach(([name, lat, lon, activities]) => {
-    // Avoid adding duplicate markers
+    // Avoid adding duplicate markers, add any new activities to the existing one instead
     const existingMarker = parkMarkers.find(marker => marker.placeName === name);
-    if (existingMarker) return;
+    if (existingMarker) {
+      existingMarker.activities = [...new Set([...existingMarker.activities, ...activities])];
+      existingMarker.setPopupContent(markerPopup(name, existingMarker.activities));
+      return;
+    }
 
     const uniqueActivities = [...new Set(activities)];
     
     // Create a Leaflet marker
     const marker = L.marker([lat, lon])
       .addTo(map)
-      .bindPopup(`<strong>${name}</strong><br>${uniqueActivities.map(a => `• ${a}`).join('<br>')}`)
+      .bindPopup(markerPopup(name, uniqueActivities))
       .on('click', () => openActivityCardByPlace(name));
 
     marker.placeName = name; // Custom property to track marker's associated place
+    marker.activities = uniqueActivities;
     parkMarkers.push(marker);
-    bounds.push([lat, lon]);
   });
 
   // Adjust map to fit all markers
+  const bounds = parkMarkers.map(marker => marker.getLatLng());
   if (bounds.length > 0) {
     map.fitBounds(bounds, { padding: [35, 35] });
   }
@@ -86,6 +94,105 @@ function addUserLocationMarker() {
   }
 }
 
+// Build the card element for one grouped activity
+function renderActivityCard(activity) {
+  const card = document.createElement('div');
+  card.className = 'activity-card';
+  card.setAttribute('data-activity-key', activity.key);
+  card.setAttribute('data-place-name', activity.location);
+
+  card.innerHTML = `
+    <div class="card-header">
+      <h2>${activity.name}</h2>
+      <p class="location">${activity.location}</p>
+    </div>
+    <p class="category"><strong>Category:</strong> ${activity.category}</p>
+    <p class="age"><strong>Age:</strong> ${activity.age_description}</p>
+    <div class="schedule">
+      <table>
+        <thead><tr><th>Date</th><th>Time</th><th>Register</th><th>More Info</th></tr></thead>
+        <tbody>
+          ${activity.date_ranges.map((date, i) => `
+            <tr>
+              <td>${date}</td>
+              <td>${activity.time_ranges[i]}</td>
+              <td>${activity.action_links[i] ? `<a href="${activity.action_links[i]}" target="_blank">Register</a>` : '-'}</td>
+              <td>${activity.detail_links[i] ? `<a href="${activity.detail_links[i]}" target="_blank">More Info</a>` : '-'}</td>
+            </tr>
+          `).join('')}
+        </tbody>
+      </table>
+    </div>
+    <p class="desc">${activity.desc || ''}</p>
+  `;
+  return card;
+}
+
+// Add a card for an activity, or replace its card if the activity is already shown
+function upsertActivityCard(activity) {
+  const container = document.getElementById('results-container');
+  const card = renderActivityCard(activity);
+  const existing = [...container.querySelectorAll('.activity-card')]
+    .find(el => el.getAttribute('data-activity-key') === activity.key);
+
+  if (existing) {
+    existing.replaceWith(card);
+  } else {
+    container.appendChild(card);
+  }
+  activityCards.set(activity.location, card);
+}
+
+// Read a search streamed as NDJSON, rendering each batch of activities as it arrives
+async function streamResults() {
+  const loading = document.getElementById('results-loading');
+  const button = document.getElementById('load-more-btn');
+
+  try {
+    const res = await fetch('/search/stream', { method: 'POST' });
+    if (!res.ok) {
+      console.error('Failed to stream activities');
+      return;
+    }
+
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+
+      buffer += decoder.decode(value, { stream: true });
+      const lines = buffer.split('\n');
+      buffer = lines.pop(); // Keep any partial line for the next chunk
+
+      lines.filter(line => line.trim()).forEach(line => {
+        const data = JSON.parse(line);
+        if (data.done) {
+          button.style.display = data.more_results_to_fetch ? 'block' : 'none';
+          if (data.next_page) {
+            sessionStorage.setItem('currentPage', data.next_page);
+          }
+          if (data.error) {
+            document.getElementById('no-results').textContent = data.error;
+          }
+          return;
+        }
+        data.activities.forEach(upsertActivityCard);
+        renderMapMarkers(data.activity_parks);
+      });
+    }
+  } catch (error) {
+    console.error('Error while streaming activities:', error);
+  } finally {
+    loading.style.display = 'none';
+    if (!document.querySelector('#results-container .activity-card')) {
+      document.getElementById('no-results').style.display = 'block';
+    }
+  }
+}
+
 // Load more activities via AJAX
 async function loadMoreActivities() {
   const button = document.getElementById('load-more-btn');
@@ -95,7 +202,6 @@ async function loadMoreActivities() {
   try {
     // Determine which page to load next
     let currentPage = parseInt(sessionStorage.getItem('currentPage')) || 6;
-    sessionStorage.setItem('currentPage', currentPage + 5);
 
     const res = await fetch('/load_more', {
       method: 'POST',
@@ -107,47 +213,19 @@ async function loadMoreActivities() {
     button.innerText = 'Load More Activities';
 
     if (!res.ok) {
+      // Leave the page counter alone so clicking again retries the same batch
       console.error('Failed to load more activities');
       return;
     }
 
     const data = await res.json();
-    const container = document.getElementById('results-container');
+    // Continue from the first page not fetched, a batch cut short by upstream ends early
+    if (data.next_page) {
+      sessionStorage.setItem('currentPage', data.next_page);
+    }
 
     // Create and append new activity cards
-    data.activities.forEach(activity => {
-      const card = document.createElement('div');
-      card.className = 'activity-card';
-      card.setAttribute('data-place-name', activity.location);
-
-      card.innerHTML = `
-        <div class="card-header">
-          <h2>${activity.name}</h2>
-          <p class="location">${activity.location}</p>
-        </div>
-        <p class="category"><strong>Category:</strong> ${activity.category}</p>
-        <p class="age"><strong>Age:</strong> ${activity.age_description}</p>
-        <div class="schedule">
-          <table>
-            <thead><tr><th>Date</th><th>Time</th><th>Register</th><th>More Info</th></tr></thead>
-            <tbody>
-              ${activity.date_ranges.map((date, i) => `
-                <tr>
-                  <td>${date}</td>
-                  <td>${activity.time_ranges[i]}</td>
-                  <td>${activity.action_links[i] ? `<a href="${activity.action_links[i]}" target="_blank">Register</a>` : '-'}</td>
-                  <td>${activity.detail_links[i] ? `<a href="${activity.detail_links[i]}" target="_blank">More Info</a>` : '-'}</td>
-                </tr>
-              `).join('')}
-            </tbody>
-          </table>
-        </div>
-        <p class="desc">${activity.desc || ''}</p>
-      `;
-
-      container.appendChild(card);
-      activityCards.set(activity.location, card);
-    });
+    data.activities.forEach(upsertActivityCard);
 
     renderMapMarkers(data.activity_parks); // Add new parks to the map
 
@@ -179,5 +257,14 @@ document.addEventListener('DOMContentLoaded', () => {
     }
   });
 
+  // Where load more picks up, as recorded with the search
+  if (window.nextPage) {
+    sessionStorage.setItem('currentPage', window.nextPage);
+  }
+
   initMap(); // Start everything
+
+  if (window.streamPending === true) {
+    streamResults(); // Fill in the search as it arrives
+  }
 });